@@ -0,0 +1,30 @@
+"""
+Helpers shared by the tests.
+"""
+
+from whip.util import ip_str_to_int
+
+IPV4_BASE = 0xffff00000000  # IPv4-mapped IPv6 addresses
+
+
+def iter_snapshot(datetime, ranges):
+    """Helper to create test data from (begin, end, x) tuples
+
+    Addresses are strings, or offsets into the IPv4 address space. If x
+    is a dict, it contains the fields instead of just x.
+    """
+    for begin, end, x in ranges:
+        if isinstance(begin, int):
+            begin, end = IPV4_BASE + begin, IPV4_BASE + end
+        else:
+            begin, end = ip_str_to_int(begin), ip_str_to_int(end)
+        info = dict(x) if isinstance(x, dict) else dict(x=x)
+        info['datetime'] = datetime
+        yield begin, end, info
+
+
+def block_ranges(values):
+    """Build ranges for the blocks 1.0.0.0/24, 2.0.0.0/24, and so on."""
+    return [
+        ('{}.0.0.0'.format(n), '{}.0.0.255'.format(n), x)
+        for n, x in enumerate(values, 1)]
@@ -0,0 +1,61 @@
+
+import io
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from whip.cli import lookup, serve
+from whip.db import Database
+from whip.json import loads as json_loads
+from whip.util import ip_str_to_int
+import whip.cli
+import whip.enrich
+import whip.sort
+
+
+def test_cli_imports():
+    # Modules only needed by some commands are imported lazily, since
+    # imports make up most of the time needed for one-shot lookups.
+    code = (
+        'import sys, whip.cli; '
+        'print(" ".join(sorted(m for m in ('
+        '"gzip", "flask", "msgpack", "plyvel", "whip.db", "whip.enrich", '
+        '"whip.reader", "whip.shard", "whip.sort", "whip.web") '
+        'if m in sys.modules)))')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b''
+
+    # The command line interface has its own copies of these.
+    assert whip.cli.FORMATS == whip.enrich.FORMATS
+    assert whip.cli.OVERLAP_POLICIES == whip.sort.OVERLAP_POLICIES
+
+
+def test_cli_lookup_stdin():
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load([
+            (ip_str_to_int('1.0.0.0'), ip_str_to_int('1.0.0.255'),
+             dict(x=1, datetime='2010'))])
+        db.close()
+
+        stdin = io.TextIOWrapper(io.BytesIO(b'1.0.0.1\n2.0.0.1\nfoo\n\n'))
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            lookup([], db_dir, None)
+        lines = stdout.buffer.getvalue().splitlines()
+        assert len(lines) == 4
+        assert json_loads(lines[0])['x'] == 1
+        assert lines[1:] == [b'{}', b'{}', b'{}']
+
+
+def test_cli_serve_options():
+    from whip.web import app as web_app
+    with mock.patch.object(web_app, 'run'), \
+            mock.patch.dict(web_app.config):
+        serve(
+            '0', 5555, 'db', profile='load', compression='none',
+            lru_cache_size=None, fill_cache=True)
+        assert web_app.config['DATABASE_OPTIONS'] == dict(
+            profile='load', compression='none', fill_cache=True)
+        web_app.run.assert_called_once_with(host='0', port=5555)
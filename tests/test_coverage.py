@@ -0,0 +1,39 @@
+
+from whip.coverage import Coverage
+from whip.util import ip_str_to_int, ip_str_to_packed
+
+
+def test_coverage():
+
+    ranges = [
+        ('1.0.0.0', '1.0.0.255'),
+        ('1.0.2.17', '1.0.2.18'),
+        ('1.0.7.0', '1.0.18.255'),
+        ('10.0.0.0', '10.255.255.255'),
+        ('2001::1', '2001::ff'),
+        ('2001:0:0:1::', '2001:0:0:1::ff'),
+        ('2002::', '2003::'),
+    ]
+
+    coverage = Coverage()
+    for begin, end in ranges:
+        coverage.add(ip_str_to_int(begin), ip_str_to_int(end))
+
+    def check(coverage):
+        covered = [
+            '1.0.0.0', '1.0.0.255', '1.0.2.0', '1.0.2.255', '1.0.7.0',
+            '1.0.8.1', '1.0.18.255', '10.1.2.3', '2001::', '2001::1:0',
+            '2001:0:0:1::ff', '2002:1234::1', '2003::',
+        ]
+        not_covered = [
+            '0.0.0.0', '1.0.1.0', '1.0.3.0', '1.0.6.255', '1.0.19.0',
+            '9.255.255.255', '11.0.0.0', '255.255.255.255', '::',
+            '2001:0:0:2::', '2000::', '2003:0:0:1::',
+        ]
+        for ip in covered:
+            assert coverage.covers(ip_str_to_packed(ip)), ip
+        for ip in not_covered:
+            assert not coverage.covers(ip_str_to_packed(ip)), ip
+
+    check(coverage)
+    check(Coverage.from_bytes(*coverage.to_bytes()))
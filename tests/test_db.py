@@ -1,9 +1,38 @@
 
+import gzip
+import io
+import itertools
+import os
+import random
 import tempfile
+import threading
+from unittest import mock
 
-from whip.db import Database
-from whip.json import loads as json_loads
-from whip.util import ip_str_to_int
+import msgpack
+from nose.tools import assert_list_equal, assert_raises
+import plyvel
+
+from whip.db import (
+    AUTOTUNE_SPARE_OPEN_FILES,
+    autotune_options,
+    build_key_value,
+    build_record,
+    Database,
+    HISTORY_PREFIX,
+    LEGACY_RECORD_FORMAT_VERSION,
+    META_PREFIX,
+    PROFILES,
+    RECORD_HEADER,
+    RECORD_PREFIX,
+    RetentionPolicy,
+    SLOTS,
+)
+from whip.delta import iter_diff
+from whip.json import dumps as json_dumps, loads as json_loads
+from whip.reader import ResumableReader
+from whip.util import ip_int_to_str, ip_str_to_int, ip_str_to_packed
+
+from helpers import IPV4_BASE, iter_snapshot
 
 
 def test_db_loading():
@@ -117,3 +146,651 @@ def test_db_loading():
         [s2, s1],
         [s1],
     )
+
+
+def test_db_migration():
+
+    def legacy_key_value(begin, end, x, datetime, history=(), header=False):
+        """Build a key/value pair in a legacy format
+
+        This uses the oldest (Msgpack) format, or the binary header
+        format with inline history if `header` is true.
+        """
+        d = dict(begin=begin, end=end, x=x, datetime=datetime)
+        latest_json = json_dumps(d).encode('UTF-8')
+        datetime = datetime.encode('ascii')
+        history_msgpack = msgpack.packb(history)
+        if header:
+            value = RECORD_HEADER.pack(
+                LEGACY_RECORD_FORMAT_VERSION, ip_str_to_packed(begin),
+                len(datetime), len(latest_json), len(history_msgpack))
+            value += datetime + latest_json + history_msgpack
+        else:
+            value = msgpack.packb((
+                ip_str_to_packed(begin), latest_json, datetime,
+                history_msgpack))
+        return ip_str_to_packed(end), value
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        legacy_db = plyvel.DB(db_dir, create_if_missing=True)
+        legacy_db.put(*legacy_key_value(
+            '1.0.0.0', '1.255.255.255', 1, '2010',
+            [({'x': 0, 'datetime': '2009'}, [])]))
+        legacy_db.put(*legacy_key_value('2001::1', '2001::ff', 2, '2010'))
+        legacy_db.put(*legacy_key_value(
+            '3.0.0.0', '3.0.0.255', 3, '2011',
+            [({'x': 2, 'datetime': '2010'}, [])], header=True))
+        legacy_db.close()
+
+        # Legacy databases can be used for lookups, but must be
+        # migrated before anything else.
+        db = Database(db_dir)
+        assert json_loads(db.lookup('1.2.3.4'))['x'] == 1
+        assert json_loads(db.lookup('1.2.3.4', '2009'))['x'] == 0
+        assert db.lookup('1.2.3.4', '2008') is None
+        assert len(json_loads(db.lookup('1.2.3.4', 'all'))['history']) == 2
+        assert json_loads(db.lookup('2001::aa'))['x'] == 2
+        assert db.lookup('2001::') is None
+        assert json_loads(db.lookup('3.0.0.1'))['x'] == 3
+        assert json_loads(db.lookup('3.0.0.1', '2010'))['x'] == 2
+        assert [end for _, end, _ in db.iter_records()] == [
+            ip_str_to_int('1.255.255.255'), ip_str_to_int('3.0.0.255'),
+            ip_str_to_int('2001::ff')]
+        assert_raises(RuntimeError, db.load, [])
+        assert_raises(RuntimeError, list, db.scan('::', 'ffff::'))
+        db.migrate()
+        db.db.close()
+
+        db = Database(db_dir)
+        assert json_loads(db.lookup('1.2.3.4'))['x'] == 1
+        assert json_loads(db.lookup('1.2.3.4', '2009'))['x'] == 0
+        assert db.lookup('1.2.3.4', '2008') is None
+        assert json_loads(db.lookup('2001::aa'))['x'] == 2
+        assert json_loads(db.lookup('3.0.0.1', '2010'))['x'] == 2
+        assert db.lookup('0.1.2.3') is None
+        assert db.lookup('2001::') is None
+        assert all(
+            key.startswith((RECORD_PREFIX, HISTORY_PREFIX, META_PREFIX))
+            for key in db.db.iterator(include_value=False))
+
+        # The generation identifies the contents, so rewriting the
+        # same data does not change it.
+        generation = db.generation
+        assert generation is not None
+        db.optimize()
+        assert db.generation == generation
+
+
+def test_db_options():
+
+    def leveldb_options(**kwargs):
+        with mock.patch('plyvel.DB', wraps=plyvel.DB) as db_cls:
+            db = Database(db_dir, **kwargs)
+        db.close()
+        return db_cls.call_args[1], db.read_options
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        Database(db_dir, create_if_missing=True).close()
+
+        for profile, expected in PROFILES.items():
+            options, read_options = leveldb_options(profile=profile)
+            assert read_options == dict(
+                fill_cache=expected['fill_cache'],
+                verify_checksums=expected['verify_checksums'])
+            for name, value in expected.items():
+                if name not in read_options:
+                    assert options[name] == value
+
+        # Explicit options override the profile; None values are ignored
+        options, read_options = leveldb_options(
+            profile='load', lru_cache_size=1024, max_open_files=None,
+            fill_cache=True, compression='none')
+        assert options['lru_cache_size'] == 1024
+        assert options['max_open_files'] == PROFILES['load']['max_open_files']
+        assert options['compression'] is None
+        assert read_options['fill_cache'] is True
+
+        # Autotuning takes the database size into account
+        assert autotune_options(os.path.join(db_dir, 'missing')) == dict(
+            max_open_files=AUTOTUNE_SPARE_OPEN_FILES,
+            lru_cache_size=PROFILES['serve']['lru_cache_size'])
+        size = 4 * PROFILES['serve']['lru_cache_size']
+        tables_dir = os.path.join(db_dir, 'tables')
+        os.mkdir(tables_dir)
+        for name in ('1.ldb', '2.sst', '3.ldb', 'LOG'):
+            with open(os.path.join(tables_dir, name), 'wb') as fp:
+                fp.truncate(size // 3)
+        options = autotune_options(tables_dir)
+        assert options['max_open_files'] == AUTOTUNE_SPARE_OPEN_FILES + 3
+        assert PROFILES['serve']['lru_cache_size'] \
+            < options['lru_cache_size'] <= size
+
+        options, _ = leveldb_options(
+            profile='oneshot', autotune=True, max_open_files=100)
+        assert options['max_open_files'] == 100
+        assert options['lru_cache_size'] \
+            == autotune_options(db_dir)['lru_cache_size']
+
+
+def test_db_threaded_lookups():
+
+    n_ranges = 1000
+    n_threads = 8
+    ips = [
+        '.'.join(str(random.randrange(256)) for _ in range(4))
+        for _ in range(2000)
+    ]
+
+    step = 2 ** 32 // n_ranges
+    ranges = [(n * step, n * step + step // 2, n) for n in range(n_ranges)]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        # No lookup cache, so that all lookups hit the database.
+        db = Database(db_dir, create_if_missing=True, cache_size=0)
+        db.load(iter_snapshot('2010', ranges))
+
+        expected = [db.lookup(ip) for ip in ips]
+        assert any(expected) and not all(expected)
+
+        results = {}
+
+        def run(thread_id):
+            # Each thread uses a different lookup order
+            order = list(range(len(ips)))
+            random.shuffle(order)
+            actual = [None] * len(ips)
+            for _ in range(5):
+                for n in order:
+                    actual[n] = db.lookup(ips[n])
+            results[thread_id] = actual
+
+        threads = [
+            threading.Thread(target=run, args=(n,))
+            for n in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == n_threads
+        for actual in results.values():
+            assert actual == expected
+
+
+def test_db_in_memory():
+
+    ranges = [
+        ('::1', '::2'),
+        ('::ffff:0', '::ffff:0.0.0.10'),  # straddles IPv4 boundary
+        ('0.0.0.20', '0.0.0.30'),
+        ('1.0.0.0', '1.0.255.255'),
+        ('1.1.0.0', '1.1.0.0'),
+        ('1.1.0.2', '1.3.0.0'),
+        ('255.255.255.0', '::1:0:0:0'),  # straddles IPv4 boundary
+        ('2001::1', '2001::ff'),
+    ]
+
+    ips = [
+        '::', '::1', '::3', '::ffff:0', '0.0.0.0', '0.0.0.10', '0.0.0.11',
+        '0.0.0.20', '0.0.0.30', '0.0.0.31', '0.255.255.255', '1.0.0.0',
+        '1.0.3.4', '1.0.255.255', '1.1.0.0', '1.1.0.1', '1.1.0.2',
+        '1.2.0.0', '1.3.0.0', '1.3.0.1', '255.255.254.255',
+        '255.255.255.0', '255.255.255.255', '::1:0:0:0', '::1:0:0:1',
+        '2001::', '2001::1', '2001::ff', '2001::100', 'ffff::1',
+    ]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True, cache_size=0)
+        db.load(iter_snapshot('2010', (
+            (begin, end, n) for n, (begin, end) in enumerate(ranges))))
+        expected = [db.lookup(ip) for ip in ips]
+        assert expected.count(None) == 12
+        db.db.close()
+
+        db = Database(db_dir, cache_size=0, in_memory=True)
+        assert db.memory_index is not None
+        assert [db.lookup(ip) for ip in ips] == expected
+
+
+def test_db_coalescing():
+
+    def n_records(db):
+        return sum(1 for _ in db.records.iterator(include_value=False))
+
+    s1 = ('2010', [('1.0.0.0', '1.0.0.255', 1)])
+    s2 = ('2011', [
+        ('1.0.0.0', '1.0.0.127', 1),
+        ('1.0.0.128', '1.0.0.255', 1),
+        ('1.0.1.0', '1.0.1.255', 2),  # different data
+    ])
+
+    for snapshots in ([s1, s2], [s2, s1]):
+        with tempfile.TemporaryDirectory() as db_dir:
+            db = Database(db_dir, create_if_missing=True)
+            for snapshot in snapshots:
+                db.load(iter_snapshot(*snapshot))
+
+            assert n_records(db) == 2
+            for ip in ('1.0.0.0', '1.0.0.127', '1.0.0.128', '1.0.0.255'):
+                assert json_loads(db.lookup(ip)) == dict(x=1, datetime='2010')
+            assert json_loads(db.lookup('1.0.1.0'))['x'] == 2
+            assert db.lookup('1.0.2.0') is None
+
+    # Optimizing existing databases
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        data = build_record([dict(x=1, datetime='2010')])
+        for begin, end in [('1.0.0.0', '1.0.0.127'),
+                           ('1.0.0.128', '1.0.0.255')]:
+            key, value, _ = build_key_value(
+                ip_str_to_int(begin), ip_str_to_int(end), *data)
+            db.db.put(RECORD_PREFIX + key, value)
+
+        assert n_records(db) == 2
+        db.optimize()
+        assert n_records(db) == 1
+        assert json_loads(db.lookup('1.0.0.0'))['x'] == 1
+        assert json_loads(db.lookup('1.0.0.255'))['x'] == 1
+
+
+def test_db_scan():
+
+    ranges = [
+        ('1.0.0.0', '1.0.0.255', 1, '2010'),
+        ('1.0.2.0', '1.0.2.255', 2, '2010'),
+        ('1.0.2.0', '1.0.2.255', 3, '2011'),
+        ('1.0.3.0', '1.0.3.255', 4, '2011'),
+        ('2001::', '2001::ff', 5, '2010'),
+    ]
+
+    def scan_x(db, begin, end, datetime=None):
+        return [
+            (begin_ip, end_ip, json_loads(info_as_json)['x'])
+            for begin_ip, end_ip, info_as_json
+            in db.scan(begin, end, datetime)]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        for begin, end, x, datetime in ranges:
+            db.load(iter_snapshot(datetime, [(begin, end, x)]))
+
+        assert_list_equal(scan_x(db, '1.0.0.0', '1.255.255.255'), [
+            ('1.0.0.0', '1.0.0.255', 1),
+            ('1.0.2.0', '1.0.2.255', 3),
+            ('1.0.3.0', '1.0.3.255', 4),
+        ])
+        assert_list_equal(scan_x(db, '1.0.0.128', '1.0.2.0'), [
+            ('1.0.0.0', '1.0.0.255', 1),
+            ('1.0.2.0', '1.0.2.255', 3),
+        ])
+        assert_list_equal(scan_x(db, '1.0.1.0', '1.0.1.255'), [])
+        assert_list_equal(scan_x(db, '1.0.0.0', '1.0.3.255', '2010'), [
+            ('1.0.0.0', '1.0.0.255', 1),
+            ('1.0.2.0', '1.0.2.255', 2),
+        ])
+        assert_list_equal(scan_x(db, '::', '2001::1'), [
+            ('1.0.0.0', '1.0.0.255', 1),
+            ('1.0.2.0', '1.0.2.255', 3),
+            ('1.0.3.0', '1.0.3.255', 4),
+            ('2001::', '2001::ff', 5),
+        ])
+
+
+def test_db_index():
+
+    def find_all(db, field, value):
+        return sorted(
+            (begin, end) for begin, end, _ in db.find(field, value))
+
+    def find_all_by_scanning(db, field, value):
+        return sorted(
+            (begin, end)
+            for begin, end, info_as_json in db.scan('::', 'ffff::')
+            if str(json_loads(info_as_json).get(field)) == str(value))
+
+    snapshots = [
+        [(0, 99, 1, 'NL'), (100, 199, 2, 'NL'), (300, 399, 1, 'BE')],
+        [(50, 149, 1, 'NL'), (200, 299, 3, None), (300, 399, 2, 'BE')],
+        [(0, 399, 1, 'NL')],
+        [(0, 9, 4, 'DE'), (390, 399, 2, 'NL')],
+    ]
+    snapshots = [
+        [(begin, end, dict(asn=asn, country=country))
+         for begin, end, asn, country in snapshot]
+        for snapshot in snapshots]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load(iter_snapshot('2010', snapshots[0]))
+        assert_raises(ValueError, list, db.find('asn', 1))
+        db.set_index_fields(['asn', 'country'])
+        assert len(find_all(db, 'asn', 1)) == 2
+
+        for n, snapshot in enumerate(snapshots[1:], 2011):
+            db.load(iter_snapshot(str(n), snapshot))
+            for field, value in [('asn', 1), ('asn', '2'), ('asn', 3),
+                                 ('asn', 4), ('country', 'NL'),
+                                 ('country', 'BE'), ('country', 'DE')]:
+                assert_list_equal(
+                    find_all(db, field, value),
+                    find_all_by_scanning(db, field, value))
+
+        # Removing the index
+        db.set_index_fields([])
+        assert_raises(ValueError, list, db.find('asn', 1))
+        assert next(db.index.iterator(), None) is None
+
+
+def test_db_views():
+
+    def check_lookups(db):
+        # Scans do not use the views.
+        for n in range(0, 420, 5):
+            ip = ip_int_to_str(IPV4_BASE + n)
+            for datetime in ('2009', '2010', '2011', '2011-06', '2012'):
+                expected = None
+                for _, _, info_as_json in db.scan(ip, ip, datetime):
+                    expected = info_as_json
+                assert db._lookup(ip, datetime) == expected
+
+    snapshots = [
+        [(0, 99, 1), (100, 199, 2), (300, 399, 3)],
+        [(50, 149, 1), (200, 299, 3), (300, 399, 4)],
+        [(0, 409, 5)],
+    ]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load(iter_snapshot('2010', snapshots[0]))
+        db.set_view_datetimes(['2011', '2010'])
+        assert db.view_datetimes == ['2010', '2011']
+        check_lookups(db)
+
+        for n, snapshot in enumerate(snapshots[1:], 2011):
+            db.load(iter_snapshot(str(n), snapshot))
+            check_lookups(db)
+
+        # Lookups use the views
+        ip = ip_int_to_str(IPV4_BASE + 120)
+        with mock.patch.object(db, '_lookup_version') as lookup_version:
+            assert json_loads(db._lookup(ip, '2011'))['x'] == 1
+            assert not lookup_version.called
+
+        # Changing and removing views
+        db.set_view_datetimes(['2011', '2011-06'])
+        assert db.view_datetimes == ['2011', '2011-06']
+        check_lookups(db)
+        assert_raises(ValueError, db.set_view_datetimes, ['all'])
+        db.set_view_datetimes([])
+        assert next(db.views.iterator(), None) is None
+        check_lookups(db)
+
+
+def test_db_version_cache():
+
+    block = ('1.0.0.0', '1.0.0.255')
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        for n in range(1, 4):
+            db.load(iter_snapshot('201{}'.format(n), [block + (n,)]))
+
+        # Lookups resolving to the same version return the same bytes,
+        # and only decode the record once.
+        result = db._lookup('1.0.0.1', '2011-01')
+        assert json_loads(result)['x'] == 1
+        assert db._lookup('1.0.0.1', '2011-06') is result
+        assert json_loads(db._lookup('1.0.0.1', '2012-06'))['x'] == 2
+        assert db._lookup('1.0.0.1', '2010') is None
+        history = json_loads(db._lookup('1.0.0.1', 'all'))['history']
+        assert [d['x'] for d in history] == [3, 2, 1]
+        assert db._get_versions.cache_info().misses == 1
+
+        # New data is seen
+        db.load(iter_snapshot('2014', [block + (4,)]))
+        history = json_loads(db._lookup('1.0.0.1', 'all'))['history']
+        assert [d['x'] for d in history] == [4, 3, 2, 1]
+        db.close()
+
+
+def test_db_changelog():
+
+    def changes(db, since, until=None):
+        return [
+            (begin, end) for begin, end, _
+            in db.changes_since(since, until)]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load(iter_snapshot('2010', [
+            ('1.0.0.0', '1.0.0.99', 1),
+            ('1.0.1.0', '1.0.1.99', 2),
+        ]))
+        db.load(iter_snapshot('2011', [
+            ('1.0.0.0', '1.0.0.99', 1),  # unchanged
+            ('1.0.1.0', '1.0.1.99', 3),
+            ('1.0.2.0', '1.0.2.99', 4),
+        ]))
+        db.load(iter_snapshot('2012', [
+            ('1.0.0.50', '1.0.0.60', 5),  # splits an existing range
+            ('2001::', '2001::ff', 6),
+        ]))
+        db.load(iter_snapshot('2013', [
+            ('1.0.0.50', '1.0.0.60', 5),
+            ('2001::', '2001::ff', 6),
+        ]))
+
+        assert_list_equal(changes(db, '2010', '2011'), [
+            ('1.0.1.0', '1.0.1.99'),
+            ('1.0.2.0', '1.0.2.99'),
+        ])
+        assert_list_equal(changes(db, '2011'), [
+            ('1.0.0.0', '1.0.0.49'),
+            ('1.0.0.50', '1.0.0.60'),
+            ('1.0.0.61', '1.0.0.99'),
+            ('2001::', '2001::ff'),
+        ])
+        assert_list_equal(changes(db, '2011-06', '2012'), [
+            ('1.0.0.0', '1.0.0.49'),
+            ('1.0.0.50', '1.0.0.60'),
+            ('1.0.0.61', '1.0.0.99'),
+            ('2001::', '2001::ff'),
+        ])
+        assert_list_equal(changes(db, '2012'), [])
+        assert_list_equal(changes(db, '2013'), [])
+        assert len(changes(db, '2000')) == 6
+
+
+def test_db_delta():
+
+    assert_list_equal(
+        list(iter_diff(
+            [(b'a', b'1'), (b'b', b'2'), (b'd', b'4')],
+            [(b'b', b'2'), (b'c', b'3'), (b'd', b'5')])),
+        [(b'a', None), (b'c', b'3'), (b'd', b'5')])
+
+    def contents(db):
+        # The replica uses its own active slot.
+        return [
+            list(db.records.iterator()),
+            list(db.history.iterator()),
+            list(db.index.iterator()),
+            list(db.changelog.iterator()),
+            [(key, value) for key, value in db.meta.iterator()
+             if key != b'active-slot'],
+        ]
+
+    snapshot_1 = [
+        ('1.0.0.0', '1.0.0.99', 1),
+        ('1.0.1.0', '1.0.1.99', 2),
+        ('1.0.2.0', '1.0.2.99', 3),
+    ]
+    snapshot_2 = [
+        ('1.0.0.0', '1.0.0.99', 1),  # unchanged
+        ('1.0.1.0', '1.0.1.49', 4),
+        ('1.0.3.0', '1.0.3.99', 5),
+    ]
+
+    with tempfile.TemporaryDirectory() as master_dir, \
+            tempfile.TemporaryDirectory() as replica_dir:
+        master = Database(master_dir, create_if_missing=True)
+        master.set_index_fields(['x'])
+        master.load(iter_snapshot('2010', snapshot_1))
+
+        # The same data results in the same generation.
+        replica = Database(replica_dir, create_if_missing=True)
+        replica.set_index_fields(['x'])
+        replica.load(iter_snapshot('2010', snapshot_1))
+        assert replica.generation == master.generation
+
+        delta = io.BytesIO()
+        master.load(iter_snapshot('2011', snapshot_2), delta=delta)
+        delta_value = delta.getvalue()
+
+        # Invalid delta files do not change anything, even if multiple
+        # batches could be written before noticing.
+        before = contents(replica)
+        with mock.patch('whip.db.WRITE_BATCH_SIZE', 1):
+            for invalid in [delta_value[:-10], delta_value[:-1] + b'\x00']:
+                assert_raises(
+                    ValueError, replica.apply_delta, io.BytesIO(invalid))
+        assert contents(replica) == before
+        assert replica.generation != master.generation
+
+        # Input that is not seekable (e.g. a pipe) works as well.
+        stream = io.BufferedReader(io.BytesIO(delta_value))
+        with mock.patch.object(stream, 'seekable', return_value=False):
+            replica.apply_delta(stream)
+        assert replica.generation == master.generation
+        assert json_loads(replica.lookup('1.0.1.1'))['x'] == 4
+        assert json_loads(replica.lookup('1.0.1.51', '2010'))['x'] == 2
+        assert contents(replica) == contents(master)
+        assert len(list(replica.find('x', 4))) == 1
+        assert len(list(replica.changes_since('2010'))) == 3
+
+        # Deltas only apply to the generation they are based on.
+        assert_raises(
+            ValueError, replica.apply_delta, io.BytesIO(delta_value))
+        assert_raises(ValueError, replica.apply_delta, io.BytesIO(b'foo'))
+
+        # Resuming cannot produce a delta file.
+        assert_raises(
+            ValueError, master.load, iter_snapshot('2012', snapshot_1),
+            resume=True, delta=io.BytesIO())
+
+
+def test_db_resume():
+
+    def make_ranges(seed):
+        rng = random.Random(seed)
+        return [
+            (begin, begin + 99, rng.randrange(3))
+            for begin in range(0x01000000, 0x01000000 + 100 * 500, 100)]
+
+    def interrupted(iterable, n):
+        for item in itertools.islice(iterable, n):
+            yield item
+        raise KeyboardInterrupt
+
+    ips = [ip_int_to_str(IPV4_BASE + 0x01000000 + n)
+           for n in range(0, 50000, 37)]
+
+    with tempfile.TemporaryDirectory() as ref_dir, \
+            tempfile.TemporaryDirectory() as db_dir, \
+            mock.patch('whip.db.WRITE_BATCH_SIZE', 10):
+        db = Database(db_dir, create_if_missing=True)
+        db.load(iter_snapshot('2010', make_ranges(1)))
+        expected = [db.lookup(ip) for ip in ips]
+
+        # The input file is gzipped, to check offsets in gzip streams.
+        input_file = os.path.join(db_dir, 'input.json.gz')
+        with gzip.open(input_file, 'wb') as fp:
+            for begin, end, d in iter_snapshot('2011', make_ranges(2)):
+                d.update(begin=ip_int_to_str(begin), end=ip_int_to_str(end))
+                fp.write(json_dumps(d).encode('UTF-8') + b'\n')
+
+        ref_db = Database(ref_dir, create_if_missing=True)
+        ref_db.load(iter_snapshot('2010', make_ranges(1)))
+        with gzip.open(input_file) as fp:
+            ref_db.load(ResumableReader(fp))
+
+        # Interrupted load; the current data stays available.
+        with gzip.open(input_file) as fp:
+            reader = ResumableReader(fp)
+            assert_raises(
+                KeyboardInterrupt, db.load,
+                interrupted(reader, 300), checkpoint=lambda last_end: [
+                    reader.checkpoint(last_end)])
+        db.db.close()
+        db = Database(db_dir)
+        assert_list_equal([db.lookup(ip) for ip in ips], expected)
+        assert list(db.changes_since('2010')) == []
+
+        # Resuming
+        state = db.checkpoint_state()
+        assert state['inputs'][0] > 0
+        with gzip.open(input_file) as fp:
+            reader = ResumableReader(fp, offset=state['inputs'][0])
+            db.load(reader, resume=True)
+        assert db.checkpoint_state() is None
+        assert_list_equal(
+            [db.lookup(ip) for ip in ips],
+            [ref_db.lookup(ip) for ip in ips])
+        assert db.generation == ref_db.generation
+        assert_list_equal(
+            list(db.changes_since('2000')), list(ref_db.changes_since('2000')))
+        assert_raises(RuntimeError, db.load, resume=True)
+
+        # The inactive slot is empty.
+        prefixes = SLOTS[1 - db.slot]
+        assert not any(
+            key.startswith(prefixes) for key in db.db.iterator(
+                include_value=False))
+
+
+def test_retention():
+
+    datetimes = [
+        '2013-06-01', '2013-05-15', '2013-05-01', '2013-04-15',
+        '2013-04-01', '2013-03-20', '2013-03-10', '2013-03-01',
+    ]
+    versions = [dict(datetime=dt) for dt in datetimes]
+
+    def check(policy, expected):
+        actual = [d['datetime'] for d in policy.apply(versions)]
+        assert_list_equal(actual, expected)
+
+    check(RetentionPolicy(), datetimes)
+    check(RetentionPolicy(max_versions=3), datetimes[:3])
+    check(RetentionPolicy(max_versions=0), datetimes[:1])
+    check(RetentionPolicy(min_datetime='2013-05-10'), datetimes[:3])
+    check(RetentionPolicy(min_datetime='2013-05-15'), datetimes[:2])
+    check(RetentionPolicy(min_datetime='2000'), datetimes)
+    check(RetentionPolicy(monthly_before='2013-05-01'), [
+        '2013-06-01', '2013-05-15', '2013-05-01', '2013-04-15',
+        '2013-03-20'])
+    check(RetentionPolicy(monthly_before='2014'), [
+        '2013-06-01', '2013-05-15', '2013-04-15', '2013-03-20'])
+    check(RetentionPolicy(max_versions=2, monthly_before='2014'), [
+        '2013-06-01', '2013-05-15'])
+
+    assert not RetentionPolicy()
+    assert RetentionPolicy(max_versions=1)
+
+    # Pruning a database
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        for x, dt in enumerate(reversed(datetimes)):
+            db.load(iter([(1, 10, dict(x=x, datetime=dt))]))
+        db.load(iter([(20, 30, dict(x=0, datetime=datetimes[0]))]))
+
+        def history(ip):
+            return json_loads(db.lookup(ip, 'all'))['history']
+
+        assert len(history('::1')) == len(datetimes)
+        db.prune(RetentionPolicy(max_versions=2))
+        assert [d['x'] for d in history('::1')] == [7, 6]
+        db.prune(RetentionPolicy(max_versions=1))
+        assert [d['x'] for d in history('::1')] == [7]
+        assert [d['x'] for d in history('::14')] == [0]
+        assert next(db.history.iterator(), None) is None
@@ -0,0 +1,94 @@
+
+import io
+import tempfile
+
+from nose.tools import assert_list_equal
+
+from whip.db import Database
+from whip.enrich import enrich, enrich_csv, enrich_ndjson
+from whip.json import loads as json_loads
+from whip.util import ip_str_to_int, ip_str_to_packed
+
+
+def test_enrich():
+
+    ranges = [
+        ('1.0.0.0', '1.0.0.255', 1),
+        ('1.0.2.0', '1.0.2.255', 2),
+        ('2001::1', '2001::ff', 3),
+    ]
+    ips = [
+        '1.0.2.3', '1.0.0.1', 'invalid', '1.0.1.0', '1.0.0.255',
+        '2001::2', '1.0.0.1', '3.0.0.0', None, '1.0.2.0',
+    ]
+    expected = [2, 1, None, None, 1, 3, 1, None, None, 2]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load(
+            (ip_str_to_int(begin), ip_str_to_int(end),
+             dict(datetime='2015-01-01', x=x))
+            for begin, end, x in ranges)
+
+        for chunk_size in (None, 1, 3, 100):
+            # JSON
+            fp = io.BytesIO(b''.join(
+                b'{"ip": "%s", "n": %d}\n' % (ip.encode(), n)
+                if ip is not None else b'{}\n'
+                for n, ip in enumerate(ips)))
+            out = io.BytesIO()
+            enrich_ndjson(db, fp, out, chunk_size=chunk_size)
+            docs = [json_loads(line) for line in out.getvalue().splitlines()]
+            assert_list_equal(
+                [(d['whip'] or {}).get('x') for d in docs], expected)
+            assert_list_equal(
+                [d.get('n') for d in docs if 'ip' in d],
+                [n for n, ip in enumerate(ips) if ip is not None])
+
+            # CSV
+            fp = io.BytesIO(b''.join(
+                b'%d,%s\r\n' % (n, (ip or '').encode())
+                for n, ip in enumerate(ips)))
+            fp = io.BytesIO(b'n,ip\r\n' + fp.getvalue())
+            out = io.BytesIO()
+            enrich_csv(db, fp, out, output_field='info', chunk_size=chunk_size)
+            lines = out.getvalue().decode().splitlines()
+            assert lines[0] == 'n,ip,info'
+            assert lines[1].startswith('0,1.0.2.3,"{')
+            assert lines[3] == '2,invalid,'
+            assert len(lines) == len(ips) + 1
+
+        # Lines that are not JSON objects are passed through unchanged
+        malformed = [
+            b'not json', b'[1, 2]', b'"1.0.0.1"', b'12',
+            b'{"ip": "1.0.0.1"} trailing', b'{"ip": "1.0.0.1"}{}']
+        fp = io.BytesIO(b'\n'.join(
+            [b'{"ip": "1.0.0.1"}'] + malformed + [b'{"ip": "1.0.2.1"}  ']))
+        out = io.BytesIO()
+        enrich_ndjson(db, fp, out)
+        lines = out.getvalue().splitlines()
+        assert lines[1:-1] == malformed
+        assert json_loads(lines[0])['whip']['x'] == 1
+        assert json_loads(lines[-1])['whip']['x'] == 2
+
+        # Other ways to look up data give the same results
+        db.close()
+        for options in (dict(in_memory=True), dict(use_coverage=False)):
+            db = Database(db_dir, **options)
+            for chunk_size in (None, 3):
+                values = [
+                    json_loads(value)['x'] if value is not None else None
+                    for _, value in enrich(
+                        db, ((ip, None) for ip in ips), chunk_size)]
+                assert_list_equal(values, expected)
+            db.close()
+
+        # Without coverage information, gaps extend to the next range
+        db = Database(db_dir, use_coverage=False)
+        assert db.lookup_range(ip_str_to_packed('1.0.1.7')) == (
+            ip_str_to_int('1.0.1.7'), ip_str_to_int('1.0.1.255'), None)
+        begin, end, value = db.lookup_range(ip_str_to_packed('1.0.2.7'))
+        assert (begin, end) == (
+            ip_str_to_int('1.0.2.0'), ip_str_to_int('1.0.2.255'))
+        assert json_loads(value)['x'] == 2
+        db.close()
@@ -0,0 +1,60 @@
+
+import gzip
+import io
+import tempfile
+
+from whip.db import Database
+from whip.export import export
+from whip.json import loads as json_loads
+from whip.reader import iter_json
+
+from helpers import block_ranges, iter_snapshot
+
+
+def test_export():
+
+    s1 = block_ranges(dict(begin='ignored', x=n) for n in range(1, 10))
+    s2 = block_ranges(dict(begin='ignored', x=n) for n in range(2, 20, 2))
+    del s2[4]  # 5.0.0.0/24 only has an older version
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        db.load(iter_snapshot('2010', s1))
+        db.load(iter_snapshot('2011', s2))
+
+        fp = io.BytesIO()
+        assert export(db, fp, workers=1) == 9
+        lines = fp.getvalue().splitlines()
+        docs = list(map(json_loads, lines))
+        assert docs[0] == dict(
+            begin='1.0.0.0', end='1.0.0.255', x=2, datetime='2011')
+        assert [doc['x'] for doc in docs] == [2, 4, 6, 8, 5, 12, 14, 16, 18]
+
+        # Point in time
+        fp = io.BytesIO()
+        assert export(db, fp, datetime='2010', workers=1) == 9
+        assert {json_loads(line)['x'] for line in fp.getvalue().splitlines()} \
+            == set(range(1, 10))
+        fp = io.BytesIO()
+        assert export(db, fp, datetime='2009', workers=1) == 0
+        assert fp.getvalue() == b''
+
+        # Worker processes and compression do not affect the output
+        fp = io.BytesIO()
+        n = export(db, fp, workers=2, compresslevel=1, chunk_size=2)
+        assert n == 9
+        assert gzip.decompress(fp.getvalue()).splitlines() == lines
+
+        # The output can be loaded again
+        with tempfile.TemporaryDirectory() as copy_dir:
+            copy = Database(copy_dir, create_if_missing=True)
+            copy.load(iter_json(lines))
+            for n in range(1, 10):
+                ip = '{}.0.0.1'.format(n)
+                expected = json_loads(db.lookup(ip))
+                expected.update(
+                    begin='{}.0.0.0'.format(n), end='{}.0.0.255'.format(n))
+                assert json_loads(copy.lookup(ip)) == expected
+            copy.close()
+
+        db.close()
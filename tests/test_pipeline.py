@@ -0,0 +1,49 @@
+
+from nose.tools import assert_list_equal, assert_raises
+
+from whip.pipeline import BackgroundWriter, Prefetcher
+
+
+def test_prefetcher():
+
+    def failing():
+        yield from range(10)
+        raise ValueError("oops")
+
+    assert_list_equal(list(Prefetcher(range(1000), chunk_size=7)),
+                      list(range(1000)))
+    assert_list_equal(list(Prefetcher([])), [])
+    assert_raises(ValueError, list, Prefetcher(failing()))
+
+    # Stopping early
+    prefetcher = Prefetcher(range(10 ** 6), chunk_size=10, queue_size=2)
+    assert next(iter(prefetcher)) == 0
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+
+
+def test_background_writer():
+
+    class Batch(object):
+        def __init__(self, n):
+            self.n = n
+
+        def write(self):
+            if self.n < 0:
+                raise IOError("write failed")
+            written.append(self.n)
+
+    written = []
+    writer = BackgroundWriter(queue_size=2)
+    for n in range(100):
+        writer.write(Batch(n))
+    writer.close()
+    assert_list_equal(written, list(range(100)))
+
+    written = []
+    writer = BackgroundWriter()
+    writer.write(Batch(1))
+    writer.write(Batch(-1))
+    writer.write(Batch(2))
+    assert_raises(IOError, writer.close)
+    assert_list_equal(written, [1])
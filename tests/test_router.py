@@ -0,0 +1,137 @@
+
+import http.server
+import tempfile
+import threading
+from unittest import mock
+
+from werkzeug.exceptions import HTTPException
+
+from whip.db import Database
+from whip.json import loads as json_loads
+from whip.router import Backend
+from whip.shard import (
+    choose_shard_map,
+    load_shards,
+    shard_dir,
+    write_manifest,
+)
+import whip.router
+import whip.web
+
+from helpers import block_ranges, iter_snapshot
+
+
+def test_backend():
+    client_addresses = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            client_addresses.add(self.client_address)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        backend = Backend('http://127.0.0.1:{}/'.format(server.server_port))
+        for _ in range(3):
+            status, _, data = backend.request('GET', '/ip/1.2.3.4')
+            assert status == 200
+            assert data == b'ok'
+        assert len(client_addresses) == 1  # Connection was reused
+
+        # Idle connections closed by the server are replaced.
+        backend.idle[0].sock.close()
+        assert backend.request('GET', '/ip/1.2.3.4')[0] == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_router():
+
+    class LocalBackend(object):
+        """Backend using the REST API on a local shard database."""
+
+        def __init__(self, url):
+            self.db = shard_dbs[int(url.rsplit('/', 1)[1])]
+
+        def request(self, method, path, body=None, headers=None):
+            web_app = whip.web.app
+            with mock.patch('whip.web.db', self.db), \
+                    web_app.test_request_context(
+                        path, method=method, data=body, headers=headers):
+                try:
+                    response = web_app.make_response(
+                        web_app.dispatch_request())
+                except HTTPException as exc:
+                    response = exc.get_response()
+                return (
+                    response.status_code, list(response.headers.items()),
+                    response.get_data())
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        s1 = block_ranges(range(1, 10))
+        s2 = block_ranges(range(2, 20, 2))
+        shard_map = choose_shard_map([iter_snapshot('2010', s1)], 3)
+        write_manifest(db_dir, shard_map)
+        load_shards(db_dir, shard_map, [iter_snapshot('2010', s1)])
+        load_shards(db_dir, shard_map, [iter_snapshot('2011', s2)])
+        shard_dbs = [
+            Database(shard_dir(db_dir, n)) for n in range(len(shard_map))]
+
+        whip.router.app.config['DATABASE_DIR'] = db_dir
+        whip.router.app.config['BACKENDS'] = [
+            'http://localhost/{}'.format(n) for n in range(len(shard_map))]
+        client = whip.router.app.test_client()
+
+        with mock.patch('whip.router.Backend', LocalBackend):
+            for n in (1, 5, 9):
+                response = client.get('/ip/{}.0.0.1'.format(n))
+                assert response.status_code == 200
+                assert json_loads(response.data)['x'] == n * 2
+                assert response.headers['ETag']
+
+            response = client.get('/ip/5.0.0.1?datetime=2010')
+            assert json_loads(response.data)['x'] == 5
+            response = client.get('/ip/10.0.0.1')
+            assert response.data == b'{}'
+            response = client.get('/ip/foo')
+            assert response.status_code == 400
+
+            # Batches are split and merged again
+            response = client.post(
+                '/batch', data=b'["9.0.0.1", "1.0.0.1", "10.0.0.1"]')
+            assert response.status_code == 200
+            lines = response.data.splitlines()
+            assert [json_loads(line).get('x') for line in lines] == [
+                18, 2, None]
+            response = client.post('/batch?datetime=2010', data=b'["5.0.0.1"]')
+            assert json_loads(response.data)['x'] == 5
+            response = client.post('/batch', data=b'["foo"]')
+            assert response.status_code == 400
+
+            # Results from multiple shards are concatenated
+            response = client.get('/range/0.0.0.0/0')
+            lines = response.data.splitlines()
+            assert [json_loads(line)['info']['x'] for line in lines] == [
+                2, 4, 6, 8, 10, 12, 14, 16, 18]
+            response = client.get('/range/5.0.0.0/8')
+            assert len(response.data.splitlines()) == 1
+            response = client.get('/changes?since=2010')
+            assert len(response.data.splitlines()) == 9
+            response = client.get('/changes')
+            assert response.status_code == 400
+            response = client.get('/find/x/2')
+            assert response.status_code == 404
+
+        for db in shard_dbs:
+            db.close()
@@ -0,0 +1,84 @@
+
+import os
+import tempfile
+
+from nose.tools import assert_list_equal, assert_raises
+
+from whip.db import Database
+from whip.json import loads as json_loads
+from whip.shard import (
+    choose_shard_map,
+    load_shards,
+    read_manifest,
+    shard_dir,
+    ShardMap,
+    ShardSplitter,
+    write_manifest,
+)
+from whip.util import ip_str_to_int
+
+from helpers import block_ranges, iter_snapshot
+
+
+def test_shard_map():
+    shard_map = ShardMap([0, 100, 200])
+    assert len(shard_map) == 3
+    assert shard_map.shard_for(0) == 0
+    assert shard_map.shard_for(99) == 0
+    assert shard_map.shard_for(100) == 1
+    assert shard_map.shard_for(2 ** 128 - 1) == 2
+    assert list(shard_map.shards_for_range(50, 150)) == [0, 1]
+    assert shard_map.shard_range(0) == (0, 99)
+    assert shard_map.shard_range(2) == (200, 2 ** 128 - 1)
+
+    assert ShardMap.from_json(shard_map.to_json()).begins == [0, 100, 200]
+    assert_raises(ValueError, ShardMap, [1, 100])
+    assert_raises(ValueError, ShardMap, [0, 200, 100])
+
+
+def test_split():
+    shard_map = ShardMap([0, 100, 200])
+    splitter = ShardSplitter(
+        [(10, 20, 'a'), (90, 250, 'b'), (260, 270, 'c')], shard_map)
+    assert_list_equal(list(splitter.shard(0)), [(10, 20, 'a'), (90, 99, 'b')])
+    assert_list_equal(list(splitter.shard(1)), [(100, 199, 'b')])
+    assert_list_equal(
+        list(splitter.shard(2)), [(200, 250, 'b'), (260, 270, 'c')])
+
+    # Skipping shards
+    splitter = ShardSplitter([(10, 20, 'a'), (150, 160, 'b')], shard_map)
+    assert_list_equal(list(splitter.shard(1)), [(150, 160, 'b')])
+
+
+def test_choose_shard_map():
+    ranges = [(n * 10, n * 10 + 5, None) for n in range(1, 101)]
+    assert choose_shard_map([ranges], 4).begins == [0, 260, 510, 760]
+    assert choose_shard_map([ranges], 4, sample_size=10).begins[0] == 0
+    assert len(choose_shard_map([ranges[:2]], 4)) == 3
+    assert len(choose_shard_map([], 4)) == 1
+    assert_raises(ValueError, choose_shard_map, [ranges], 0)
+
+
+def test_load_shards():
+
+    s1 = block_ranges([1] * 9)
+    s2 = block_ranges([2] * 9)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        assert read_manifest(db_dir) is None
+        shard_map = choose_shard_map([iter_snapshot('2010', s1)], 3)
+        write_manifest(db_dir, shard_map)
+        assert read_manifest(db_dir).begins == shard_map.begins
+
+        load_shards(db_dir, shard_map, [iter_snapshot('2010', s1)])
+        load_shards(db_dir, shard_map, [iter_snapshot('2011', s2)])
+        assert sorted(os.listdir(db_dir)) == [
+            'shard-0', 'shard-1', 'shard-2', 'shards.json']
+
+        for n in range(1, 10):
+            ip = '{}.0.0.1'.format(n)
+            db = Database(shard_dir(
+                db_dir, shard_map.shard_for(ip_str_to_int(ip))))
+            assert json_loads(db.lookup(ip))['x'] == 2
+            assert json_loads(db.lookup(ip, '2010'))['x'] == 1
+            db.close()
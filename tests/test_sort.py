@@ -0,0 +1,40 @@
+
+import random
+
+from nose.tools import assert_list_equal, assert_raises
+
+from whip.sort import external_sort, resolve_overlaps
+
+
+def test_external_sort():
+    items = [(begin, begin + random.randrange(5), {'n': begin})
+             for begin in range(0, 1000, 3)]
+    expected = list(items)
+    random.shuffle(items)
+
+    # In memory, and using temporary files
+    for buffer_size in (10000, 1000, 100, 7, 1):
+        actual = list(external_sort(items, buffer_size))
+        assert_list_equal(actual, expected)
+
+    assert_list_equal(list(external_sort([], 10)), [])
+
+
+def test_resolve_overlaps():
+    items = [
+        (0, 9, 'a'),
+        (5, 14, 'b'),
+        (6, 8, 'c'),
+        (15, 20, 'd'),
+        (15, 25, 'e'),
+    ]
+
+    assert_raises(ValueError, list, resolve_overlaps(items))
+    assert_raises(ValueError, list, resolve_overlaps(items, 'invalid'))
+
+    actual = list(resolve_overlaps(items, 'skip'))
+    assert_list_equal(actual, [(0, 9, 'a'), (15, 20, 'd')])
+
+    actual = list(resolve_overlaps(items, 'clip'))
+    expected = [(0, 9, 'a'), (10, 14, 'b'), (15, 20, 'd'), (21, 25, 'e')]
+    assert_list_equal(actual, expected)
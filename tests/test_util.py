@@ -3,6 +3,7 @@ from nose.tools import (
     assert_dict_equal,
     assert_equal,
     assert_list_equal,
+    assert_raises,
 )
 
 from whip.util import (
@@ -14,6 +15,7 @@ from whip.util import (
     ip_int_to_str,
     ip_packed_to_int,
     ip_packed_to_str,
+    ip_prefix_to_int_range,
     ip_str_to_int,
     ip_str_to_packed,
     merge_ranges,
@@ -68,6 +70,25 @@ def test_ip_conversion():
         assert_equal(ip_packed_to_str(as_packed), as_str)
 
 
+def test_ip_prefixes():
+
+    items = [
+        ('10.1.2.3/8', '10.0.0.0', '10.255.255.255'),
+        ('1.2.3.4', '1.2.3.4', '1.2.3.4'),
+        ('0.0.0.0/0', '0.0.0.0', '255.255.255.255'),
+        ('2001:db8::1/32',
+         '2001:db8::', '2001:db8:ffff:ffff:ffff:ffff:ffff:ffff'),
+    ]
+    for prefix, begin, end in items:
+        assert_equal(
+            ip_prefix_to_int_range(prefix),
+            (ip_str_to_int(begin), ip_str_to_int(end)))
+
+    assert_raises(ValueError, ip_prefix_to_int_range, '1.2.3.4/33')
+    assert_raises(ValueError, ip_prefix_to_int_range, '1.2.3.4/x')
+    assert_raises(OSError, ip_prefix_to_int_range, 'x/8')
+
+
 def test_merge_ranges():
 
     # Single input
@@ -0,0 +1,73 @@
+
+import tempfile
+
+from whip.db import Database
+from whip.json import loads as json_loads
+import whip.web
+
+from helpers import block_ranges, iter_snapshot
+
+
+def test_web():
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = Database(db_dir, create_if_missing=True)
+        assert db.generation is None
+        db.load(iter_snapshot('2010', block_ranges([1])))
+        assert db.generation is not None
+
+        db.db.close()
+
+        whip.web.app.config['DATABASE_DIR'] = db_dir
+        client = whip.web.app.test_client()
+
+        response = client.get('/ip/1.0.0.1')
+        assert response.status_code == 200
+        assert json_loads(response.data)['x'] == 1
+        etag = response.headers['ETag']
+        assert response.headers['Last-Modified']
+        assert 'max-age=' in response.headers['Cache-Control']
+
+        # Conditional requests
+        response = client.get('/ip/1.0.0.1', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+
+        # New data invalidates the entity tags
+        whip.web.db.load(iter_snapshot('2011', block_ranges([2])))
+        response = client.get('/ip/1.0.0.1', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert json_loads(response.data)['x'] == 2
+        assert response.headers['ETag'] != etag
+
+        # Range queries
+        response = client.get('/range/1.0.0.0/16')
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        lines = response.data.splitlines()
+        assert len(lines) == 1
+        assert json_loads(lines[0])['info']['x'] == 2
+        assert json_loads(lines[0])['begin'] == '1.0.0.0'
+        response = client.get('/range/2.0.0.0/8')
+        assert response.data == b''
+        response = client.get('/range/1.0.0.0/99')
+        assert response.status_code == 400
+
+        # Attribute queries
+        response = client.get('/find/x/2')
+        assert response.status_code == 404
+        whip.web.db.set_index_fields(['x'])
+        response = client.get('/find/x/2')
+        assert response.status_code == 200
+        assert json_loads(response.data)['begin'] == '1.0.0.0'
+        response = client.get('/find/x/1')
+        assert response.data == b''
+
+        # Change log queries
+        response = client.get('/changes?since=2010')
+        assert json_loads(response.data)['info']['x'] == 2
+        response = client.get('/changes?since=2011')
+        assert response.data == b''
+        response = client.get('/changes')
+        assert response.status_code == 400
@@ -4,24 +4,29 @@ Whip command line interface module.
 
 # pylint: disable=missing-docstring
 
+# Many invocations are short-lived (e.g. a few lookups), so modules that
+# are only needed by some commands are imported by those commands. This
+# includes the database module, which imports Plyvel and Msgpack.
+
 import argparse
-import gzip
-import io
 import json
 import logging
 import os
-import socket
 import sys
 import time
 
 import aaargh
 
-from .db import Database
-from .reader import iter_json
+from .util import ip_int_to_str, ip_prefix_to_int_range
 
 
 logger = logging.getLogger(__name__)
 
+# Copies of whip.enrich.FORMATS and whip.sort.OVERLAP_POLICIES, which
+# are needed to define the arguments.
+FORMATS = ('ndjson', 'csv')
+OVERLAP_POLICIES = ('error', 'skip', 'clip')
+
 
 def lookup_and_print(db, ip, dt):
     value = db.lookup(ip, dt)
@@ -35,43 +40,411 @@ def lookup_and_print(db, ip, dt):
     print(json.dumps(parsed, indent=2, sort_keys=True))
 
 
+def print_ranges(results):
+    from .db import format_range_json
+    out = sys.stdout.buffer
+    for result in results:
+        out.write(format_range_json(*result))
+        out.write(b'\n')
+    out.flush()
+
+
+def open_compressed(fp):
+    if getattr(fp, 'name', '').endswith('.gz'):
+        import gzip
+        fp = gzip.open(fp)
+    return fp
+
+
+def megabytes(s):
+    return int(float(s) * 1024 * 1024)
+
+
 app = aaargh.App(description="Fast IP geo lookup")
 app.arg('--db', default='db', dest='db_dir')
 
+# LevelDB tuning options. These are passed to the Database constructor;
+# unspecified options use the defaults for the command's profile.
+app.arg('--cache-size', type=megabytes, dest='lru_cache_size',
+        help="LevelDB block cache size (in MB)")
+app.arg('--write-buffer-size', type=megabytes,
+        help="LevelDB write buffer size (in MB)")
+app.arg('--max-open-files', type=int,
+        help="Maximum number of open LevelDB files")
+app.arg('--block-size', type=int,
+        help="LevelDB block size (in bytes)")
+app.arg('--bloom-filter-bits', type=int,
+        help="Bloom filter bits per key (0 to disable)")
+app.arg('--compression', choices=['snappy', 'none'],
+        help="LevelDB compression")
+app.arg('--no-fill-cache', action='store_false', dest='fill_cache',
+        default=None, help="Do not fill the block cache on lookups")
+app.arg('--verify-checksums', action='store_true', default=None,
+        help="Verify checksums on lookups")
+app.arg('--autotune', action='store_true',
+        help="Size caches based on the database size")
+app.arg('--lookup-cache-size', type=int, dest='cache_size',
+        help="Number of lookup results to cache")
+app.arg('--version-cache-size', type=int,
+        help="Number of records with decoded history to cache")
+app.arg('--in-memory', action='store_true',
+        help="Keep an in-memory index for latest version lookups")
+
+
+def database_options(**db_options):
+    return {k: v for k, v in db_options.items() if v is not None}
+
+
+def open_db(db_dir, **db_options):
+    from .db import Database
+    return Database(db_dir, **database_options(**db_options))
+
+
+def retention_args(func):
+    app.cmd_arg('--keep-versions', type=int, dest='max_versions',
+                help="Keep at most this many versions per range")
+    app.cmd_arg('--keep-since', dest='min_datetime',
+                help="Drop versions superseded before this datetime")
+    app.cmd_arg('--monthly-before', dest='monthly_before',
+                help="Keep one version per month before this datetime")
+    return func
+
 
 @app.cmd(name='load', help="Load data")
-@app.cmd_arg('inputs', type=argparse.FileType('rb'), nargs='+')
-def load_data(db_dir, inputs):
+@app.cmd_arg('inputs', type=argparse.FileType('rb'), nargs='*')
+@app.cmd_arg('--sort', action='store_true',
+             help="Sort the input files first (using bounded memory)")
+@app.cmd_arg('--sort-buffer-size', type=int,
+             help="Number of records to sort in memory")
+@app.cmd_arg('--tmp-dir', help="Directory for temporary files")
+@app.cmd_arg('--overlaps', choices=OVERLAP_POLICIES,
+             help="How to handle overlapping ranges")
+@app.cmd_arg('--resume', action='store_true',
+             help="Resume an interrupted load (using the same inputs)")
+@app.cmd_arg('--shards', type=int,
+             help="Create a sharded database with this many shards")
+@app.cmd_arg('--delta', dest='delta_file',
+             help="Write the changes to a delta file (for apply-delta)")
+@retention_args
+def load_data(db_dir, inputs, sort, sort_buffer_size, tmp_dir, overlaps,
+              resume, shards, delta_file, max_versions, min_datetime,
+              monthly_before, **db_options):
 
     logger.info(
         "Importing %d data files: %r",
         len(inputs), ', '.join(x.name for x in inputs))
 
-    def gzip_wrap(fp):
-        if fp.name.endswith('.gz'):
-            return gzip.open(fp, mode='rt', encoding='UTF-8')
-        else:
-            return io.TextIOWrapper(fp, encoding='UTF-8')
+    from .db import RetentionPolicy
+    from .shard import read_manifest
+
+    # Sharded databases are detected automatically; --shards is only
+    # needed when creating one.
+    shard_map = read_manifest(db_dir)
+    if shard_map is not None or shards is not None:
+        if delta_file is not None:
+            logger.error("Delta files are not supported for sharded databases")
+            return 1
+        return load_sharded(
+            db_dir, shard_map, shards, inputs, sort, sort_buffer_size,
+            tmp_dir, overlaps, resume,
+            RetentionPolicy(max_versions, min_datetime, monthly_before),
+            db_options)
+
+    db = open_db(db_dir, create_if_missing=True, profile='load', **db_options)
+
+    # Sorted input is read completely before loading starts, so file
+    # offsets are only tracked (and used when resuming) for unsorted
+    # input. The database skips anything that was already written.
+    offsets = [0] * len(inputs)
+    if resume:
+        if delta_file is not None:
+            logger.error("Cannot write a delta file when resuming")
+            return 1
+        state = db.checkpoint_state()
+        if state is None:
+            logger.error("No interrupted load to resume")
+            return 1
+        if state['inputs'] is not None:
+            offsets = state['inputs']
+        if len(offsets) != len(inputs):
+            logger.error("Inputs do not match the interrupted load")
+            return 1
+
+    def checkpoint(last_end):
+        if sort:
+            return None
+        return [reader.checkpoint(last_end) for reader in readers]
+
+    readers = list(map(open_input, inputs, offsets))
+    iters = prepare_inputs(
+        readers, sort, sort_buffer_size, tmp_dir, overlaps)
+    retention = RetentionPolicy(max_versions, min_datetime, monthly_before)
+    if delta_file is None:
+        db.load(
+            *iters, retention=retention, checkpoint=checkpoint,
+            resume=resume)
+        return
+
+    # Only a complete delta file is put in place. For gzip, the default
+    # compression level is much slower, and hardly saves any space.
+    if delta_file.endswith('.gz'):
+        import gzip
+        delta = gzip.open(delta_file + '.tmp', 'wb', compresslevel=6)
+    else:
+        delta = open(delta_file + '.tmp', 'wb')
+    with delta:
+        db.load(*iters, retention=retention, checkpoint=checkpoint,
+                delta=delta)
+    os.replace(delta_file + '.tmp', delta_file)
+
+
+def open_input(fp, offset=0):
+    from .reader import ResumableReader
+    return ResumableReader(open_compressed(fp), offset=offset)
+
+
+def prepare_inputs(readers, sort, sort_buffer_size, tmp_dir, overlaps):
+    from .sort import DEFAULT_BUFFER_SIZE, external_sort, resolve_overlaps
+
+    if sort_buffer_size is None:
+        sort_buffer_size = DEFAULT_BUFFER_SIZE
+    iters = readers
+    if sort:
+        iters = (
+            external_sort(it, sort_buffer_size, tmp_dir) for it in iters)
+        if overlaps is None:
+            overlaps = 'error'
+    if overlaps is not None:
+        iters = (resolve_overlaps(it, overlaps) for it in iters)
+    return list(iters)
+
+
+def load_sharded(db_dir, shard_map, shards, inputs, sort, sort_buffer_size,
+                 tmp_dir, overlaps, resume, retention, db_options):
+    from .shard import choose_shard_map, load_shards, write_manifest
+
+    if resume:
+        logger.error("Resuming is not supported for sharded databases")
+        return 1
+
+    if shard_map is None:
+        if os.path.exists(db_dir) and os.listdir(db_dir):
+            logger.error("Database %r exists and is not sharded", db_dir)
+            return 1
+        if not inputs or not all(fp.seekable() for fp in inputs):
+            logger.error("Creating shards requires (seekable) input files")
+            return 1
+
+        # The shard boundaries are based on the input data, which is
+        # read twice.
+        logger.info("Choosing boundaries for %d shards", shards)
+        shard_map = choose_shard_map(map(open_input, inputs), shards)
+        for fp in inputs:
+            fp.seek(0)
+        write_manifest(db_dir, shard_map)
+    elif shards is not None and shards != len(shard_map):
+        logger.error(
+            "Database %r has %d shards, not %d",
+            db_dir, len(shard_map), shards)
+        return 1
+
+    readers = list(map(open_input, inputs))
+    load_shards(
+        db_dir, shard_map,
+        prepare_inputs(readers, sort, sort_buffer_size, tmp_dir, overlaps),
+        retention=retention, profile='load', **database_options(**db_options))
+
+
+@app.cmd(name='migrate', help="Convert database to the current format")
+def migrate(db_dir, **db_options):
+    db = open_db(db_dir, check_format=False, profile='load', **db_options)
+    db.migrate()
+
+
+@app.cmd(name='optimize', help="Coalesce adjacent identical ranges")
+def optimize(db_dir, **db_options):
+    db = open_db(db_dir, profile='load', **db_options)
+    db.optimize()
+
+
+@app.cmd(name='prune', help="Apply a retention policy to all ranges")
+@retention_args
+def prune(db_dir, max_versions, min_datetime, monthly_before, **db_options):
+    from .db import RetentionPolicy
+    retention = RetentionPolicy(max_versions, min_datetime, monthly_before)
+    if not retention:
+        logger.error("No retention policy specified")
+        return 1
+    db = open_db(db_dir, profile='load', **db_options)
+    db.prune(retention)
+
+
+@app.cmd(name='apply-delta', help="Apply a delta file written while loading")
+@app.cmd_arg('delta_file', type=argparse.FileType('rb'))
+def apply_delta(db_dir, delta_file, **db_options):
+    db = open_db(db_dir, profile='load', **db_options)
+    try:
+        db.apply_delta(open_compressed(delta_file))
+    except ValueError as exc:
+        logger.error("%s", exc)
+        return 1
+
+
+@app.cmd(name='enrich', help="Enrich records with IP information")
+@app.cmd_arg('inputs', type=argparse.FileType('rb'), nargs='*',
+             help="Input files (default: standard input)")
+@app.cmd_arg('--format', choices=FORMATS, default='ndjson', dest='fmt')
+@app.cmd_arg('--ip-field', default='ip',
+             help="Field containing the IP address")
+@app.cmd_arg('--output-field', default='whip',
+             help="Field to store the information in")
+@app.cmd_arg('--sort-merge', action='store_true',
+             help="Sort chunks of records by IP address before lookups")
+@app.cmd_arg('--chunk-size', type=int,
+             help="Number of records per chunk when using --sort-merge")
+def enrich(db_dir, inputs, fmt, ip_field, output_field, sort_merge,
+           chunk_size, **db_options):
+    from .enrich import DEFAULT_CHUNK_SIZE, enrich_csv, enrich_ndjson
 
-    inputs = map(gzip_wrap, inputs)
-    iters = map(iter_json, inputs)
-    db = Database(db_dir, create_if_missing=True)
-    db.load(*list(iters))
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    db = open_db(db_dir, **db_options)
+    enrich_fn = enrich_csv if fmt == 'csv' else enrich_ndjson
+    out = sys.stdout.buffer
+    for fp in inputs or [sys.stdin.buffer]:
+        enrich_fn(
+            db, open_compressed(fp), out, ip_field, output_field,
+            chunk_size if sort_merge else None)
+    out.flush()
 
 
 @app.cmd(name="lookup")
-@app.cmd_arg('ips', help="The IP address(es) to lookup", nargs='+')
+@app.cmd_arg('ips', nargs='*',
+             help="The IP address(es) to lookup (default: read addresses "
+                  "from standard input, one per line)")
 @app.cmd_arg('--datetime', '--dt', dest='dt')
-def lookup(ips, db_dir, dt):
-    db = Database(db_dir)
-    for ip in ips:
-        lookup_and_print(db, ip, dt)
+def lookup(ips, db_dir, dt, **db_options):
+    if ips:
+        # Only a few lookups, so opening the database quickly matters
+        # most. Coverage information is relatively expensive to load.
+        db = open_db(
+            db_dir, profile='oneshot', use_coverage=False, **db_options)
+        for ip in ips:
+            lookup_and_print(db, ip, dt)
+        return
+
+    # Bulk lookups. This writes a line of JSON for each line of input,
+    # which is an empty document if there is no hit.
+    db = open_db(db_dir, **db_options)
+    _lookup = db.lookup
+    out = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        ip = line.strip().decode('ascii', 'replace')
+        try:
+            value = _lookup(ip, dt)
+        except (OSError, ValueError):
+            logger.warning("Invalid IP address: %r", ip)
+            value = None
+        out.write(b'{}' if value is None else value)
+        out.write(b'\n')
+    out.flush()
+
+
+@app.cmd(name="scan", help="Show all ranges overlapping a prefix")
+@app.cmd_arg('prefix', help="The IP prefix, e.g. 10.0.0.0/8")
+@app.cmd_arg('--datetime', '--dt', dest='dt')
+def scan(prefix, db_dir, dt, **db_options):
+    db = open_db(db_dir, **db_options)
+    begin, end = ip_prefix_to_int_range(prefix)
+    print_ranges(db.scan(ip_int_to_str(begin), ip_int_to_str(end), dt))
+
+
+@app.cmd(name="index", help="Configure the secondary index")
+@app.cmd_arg('fields', nargs='*',
+             help="Fields to index (none to remove the index)")
+def index(fields, db_dir, **db_options):
+    db = open_db(db_dir, profile='load', **db_options)
+    db.set_index_fields(fields)
+
+
+@app.cmd(name="views", help="Configure materialised views")
+@app.cmd_arg('datetimes', nargs='*',
+             help="Datetimes to keep views for (none to remove all views)")
+def views(datetimes, db_dir, **db_options):
+    db = open_db(db_dir, profile='load', **db_options)
+    try:
+        db.set_view_datetimes(datetimes)
+    except ValueError as exc:
+        logger.error("%s", exc)
+        return 1
+
+
+@app.cmd(name="find", help="Show all ranges with a field value")
+@app.cmd_arg('field', help="The (indexed) field")
+@app.cmd_arg('value', help="The value")
+def find(field, value, db_dir, **db_options):
+    db = open_db(db_dir, **db_options)
+    if field not in db.index_fields:
+        logger.error("Field %r is not indexed", field)
+        return 1
+    print_ranges(db.find(field, value))
+
+
+@app.cmd(name="changes", help="Show all ranges that changed after a datetime")
+@app.cmd_arg('since', help="Only include changes after this datetime")
+@app.cmd_arg('--until',
+             help="Only include changes at or before this datetime")
+def changes(since, until, db_dir, **db_options):
+    db = open_db(db_dir, **db_options)
+    print_ranges(db.changes_since(since, until))
+
+
+@app.cmd(name='export', help="Export all ranges as JSON")
+@app.cmd_arg('--datetime', '--dt', dest='dt',
+             help="Export the versions for this datetime (default: latest)")
+@app.cmd_arg('--output', '-o',
+             help="Output file (default: standard output); gzip compressed "
+                  "if the name ends with .gz")
+@app.cmd_arg('--workers', type=int,
+             help="Number of worker processes (default: number of CPUs)")
+def export_data(db_dir, dt, output, workers, **db_options):
+    from .export import export
+    from .shard import read_manifest, shard_dir
+
+    # The shards of a sharded database are exported in order, which
+    # results in a single export in key order.
+    shard_map = read_manifest(db_dir)
+    if shard_map is None:
+        db_dirs = [db_dir]
+    else:
+        db_dirs = [shard_dir(db_dir, n) for n in range(len(shard_map))]
+
+    # Only a complete export is put in place.
+    if output is None:
+        out = sys.stdout.buffer
+        compresslevel = None
+    else:
+        out = open(output + '.tmp', 'wb')
+        compresslevel = 6 if output.endswith('.gz') else None
+
+    n_exported = 0
+    start_time = time.time()
+    for path in db_dirs:
+        db = open_db(path, profile='load', use_coverage=False, **db_options)
+        n_exported += export(db, out, dt, workers, compresslevel)
+        db.close()
+    out.flush()
+    if output is not None:
+        out.close()
+        os.replace(output + '.tmp', output)
+    logger.info(
+        "Exported %d ranges in %.2fs", n_exported, time.time() - start_time)
 
 
 @app.cmd(name="shell")
 @app.cmd_arg('--datetime', '--dt', dest='dt')
-def shell(db_dir, dt):
-    db = Database(db_dir)
+def shell(db_dir, dt, **db_options):
+    db = open_db(db_dir, **db_options)
     try:
         while True:
             ip = input('IP: ')
@@ -81,12 +454,20 @@ def shell(db_dir, dt):
 
 
 @app.cmd(name='perftest', help="Run performance test")
-@app.cmd_arg('--iterations', '-n', default=100 * 1000, type=int,
+@app.cmd_arg('--iterations', '-n', type=int,
              help="The number of iterations")
 @app.cmd_arg('--test-set', type=argparse.FileType('r'))
 @app.cmd_arg('--datetime', '--dt', dest='dt')
-def perftest(db_dir, iterations, test_set, dt):
-    db = Database(db_dir)
+@app.cmd_arg('--startup', action='store_true',
+             help="Measure the time needed by 'whip-cli lookup' instead")
+def perftest(db_dir, iterations, test_set, dt, startup, **db_options):
+    if startup:
+        return startup_perftest(db_dir, iterations or 20, dt)
+
+    import socket
+
+    db = open_db(db_dir, **db_options)
+    iterations = iterations or 100 * 1000
     size = 4
 
     if test_set:
@@ -113,12 +494,67 @@ def perftest(db_dir, iterations, test_set, dt):
     print('Cache statistics:', _lookup.cache_info())
 
 
+def startup_perftest(db_dir, iterations, dt):
+    import subprocess
+
+    def measure(command):
+        timings = []
+        for _ in range(iterations):
+            start_time = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start_time)
+        timings.sort()
+        return timings[len(timings) // 2] * 1000, timings[0] * 1000
+
+    logger.info("Running %d iterations of each command", iterations)
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import whip.cli', [sys.executable, '-c', 'import whip.cli']),
+        ('whip-cli lookup', [
+            sys.executable, '-m', 'whip.cli', '--db', db_dir,
+            'lookup', '1.2.3.4'] + (['--datetime', dt] if dt else [])),
+    ]
+    for name, command in commands:
+        print("{}: {:.1f} ms (median), {:.1f} ms (fastest)".format(
+            name, *measure(command)))
+
+
 @app.cmd
 @app.cmd_arg('--host', default='0')
 @app.cmd_arg('--port', type=int, default=5555)
-def serve(host, port, db_dir):
+@app.cmd_arg(
+    '--cache-max-age', type=int,
+    help="max-age for HTTP caching (in seconds)")
+def serve(host, port, db_dir, cache_max_age=None, **db_options):
     from .web import app as application
     application.config['DATABASE_DIR'] = db_dir
+    if cache_max_age is not None:
+        application.config['CACHE_MAX_AGE'] = cache_max_age
+    application.config['DATABASE_OPTIONS'] = database_options(**db_options)
+    application.run(host=host, port=port)
+
+
+@app.cmd(name='route', help="Route requests to the shards' servers")
+@app.cmd_arg('backends', nargs='+',
+             help="Server URLs for all shards, in order")
+@app.cmd_arg('--host', default='0')
+@app.cmd_arg('--port', type=int, default=5555)
+def route(host, port, backends, db_dir, **db_options):
+    # pylint: disable=unused-argument
+    from .shard import read_manifest
+
+    shard_map = read_manifest(db_dir)
+    if shard_map is None:
+        logger.error("Database %r is not sharded", db_dir)
+        return 1
+    if len(backends) != len(shard_map):
+        logger.error(
+            "Expected %d backend URLs, got %d", len(shard_map), len(backends))
+        return 1
+
+    from .router import app as application
+    application.config['DATABASE_DIR'] = db_dir
+    application.config['BACKENDS'] = backends
     application.run(host=host, port=port)
 
 
@@ -0,0 +1,126 @@
+"""
+Whip coverage module.
+
+This module keeps track of which parts of the IP address space are
+covered by any range in the database, so that lookups for addresses in
+gaps can be answered without touching the database at all.
+
+The coverage information is deliberately coarse, and errs on the safe
+side: if an address is reported as not covered, the database does not
+contain any range for it; if it is reported as covered, the database
+must be consulted to find out.
+
+* IPv4 coverage is kept as a bitmap with a single bit for each /24
+  network, which takes 2MB of memory.
+
+* IPv6 coverage is kept as a sorted list of non-overlapping /64 prefix
+  intervals. Lookups use a binary search.
+"""
+
+import array
+import bisect
+import sys
+
+from .util import IPV4_MAPPED_IPV6_PREFIX
+
+IPV4_BEGIN = 0xffff00000000
+IPV4_END = 0xffffffffffff
+IPV4_BITMAP_SIZE = 2 ** 24 // 8
+
+
+def _pack_array(a):
+    """Pack an array into a (little-endian) byte string"""
+    if sys.byteorder != 'little':  # pragma: no cover
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack_array(typecode, b):
+    """Unpack a (little-endian) byte string into an array"""
+    a = array.array(typecode)
+    a.frombytes(b)
+    if sys.byteorder != 'little':  # pragma: no cover
+        a.byteswap()
+    return a
+
+
+class Coverage(object):
+    """
+    Coarse-grained coverage information for IP ranges.
+
+    Ranges must be added in sorted order using add().
+    """
+
+    def __init__(self, ipv4_bitmap=None, ipv6_begins=None, ipv6_ends=None):
+        if ipv4_bitmap is None:
+            ipv4_bitmap = bytearray(IPV4_BITMAP_SIZE)
+        assert len(ipv4_bitmap) == IPV4_BITMAP_SIZE
+        self.ipv4_bitmap = ipv4_bitmap
+        self.ipv6_begins = ipv6_begins or array.array('Q')
+        self.ipv6_ends = ipv6_ends or array.array('Q')
+
+    def add(self, begin, end):
+        """Add a range, specified as integers."""
+
+        # IPv4 part (if any), using /24 granularity
+        if begin <= IPV4_END and end >= IPV4_BEGIN:
+            first = (max(begin, IPV4_BEGIN) - IPV4_BEGIN) >> 8
+            last = (min(end, IPV4_END) - IPV4_BEGIN) >> 8
+            self._set_bits(first, last)
+
+        # Anything outside the IPv4 space, using /64 granularity.
+        if begin < IPV4_BEGIN or end > IPV4_END:
+            begin >>= 64
+            end >>= 64
+            begins = self.ipv6_begins
+            ends = self.ipv6_ends
+            if ends and begin <= ends[-1] + 1:
+                # Extend the previous interval
+                assert begin >= begins[-1], "ranges not sorted"
+                ends[-1] = max(ends[-1], end)
+            else:
+                begins.append(begin)
+                ends.append(end)
+
+    def _set_bits(self, first, last):
+        """Set all bits from `first` up to and including `last`."""
+        bitmap = self.ipv4_bitmap
+        first_byte, first_bit = divmod(first, 8)
+        last_byte, last_bit = divmod(last, 8)
+
+        if first_byte == last_byte:
+            n_bits = last_bit - first_bit + 1
+            bitmap[first_byte] |= ((1 << n_bits) - 1) << first_bit
+            return
+
+        bitmap[first_byte] |= (0xff << first_bit) & 0xff
+        n_bytes = last_byte - first_byte - 1
+        bitmap[first_byte + 1:last_byte] = b'\xff' * n_bytes
+        bitmap[last_byte] |= 0xff >> (7 - last_bit)
+
+    def covers(self, ip_packed):
+        """Check whether a packed IP address may be covered by a range."""
+        if ip_packed[:12] == IPV4_MAPPED_IPV6_PREFIX:
+            n = int.from_bytes(ip_packed[12:15], 'big')
+            return bool(self.ipv4_bitmap[n >> 3] & (1 << (n & 7)))
+
+        n = int.from_bytes(ip_packed[:8], 'big')
+        idx = bisect.bisect_right(self.ipv6_begins, n) - 1
+        return idx >= 0 and self.ipv6_ends[idx] >= n
+
+    def to_bytes(self):
+        """Serialize into a pair of byte strings (IPv4 and IPv6 parts)."""
+        return (
+            bytes(self.ipv4_bitmap),
+            _pack_array(self.ipv6_begins) + _pack_array(self.ipv6_ends))
+
+    @classmethod
+    def from_bytes(cls, ipv4_value, ipv6_value):
+        """Deserialize from a pair of byte strings; see to_bytes()."""
+        ipv6_arrays = _unpack_array('Q', ipv6_value)
+        n = len(ipv6_arrays) // 2
+        return cls(
+            bytearray(ipv4_value),
+            ipv6_arrays[:n],
+            ipv6_arrays[n:])
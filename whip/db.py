@@ -17,20 +17,78 @@ Some remarks about the construction of database records:
   were first seen. Since each dict will have a different timestamp, the
   datetime will be ignored while deduplicating.
 
-The key/value layout is as follows:
+The database is split into separate keyspaces, each using its own key
+prefix:
+
+* Records, containing the latest version of each range.
+* History, containing the older versions of each range.
+* Metadata, e.g. the database format version.
+* An optional secondary index on fields of the latest version (see
+  below).
+* A change log, listing which ranges changed at which datetime.
+* Optional materialised views, containing the version of each range at
+  a specific datetime (see below).
+
+Each operation that rewrites the database stores a new 'generation':
+a digest of the complete database contents, and the time at which it
+was written. This identifies the data set, e.g. for HTTP caching.
+
+This keeps the working set for the vast majority of lookups, which ask
+for the latest version, as small as possible: lookups never read any
+history data, unless explicitly asked for.
+
+The key/value layout for records is as follows:
 
 * The end IP is used as the key. This allows for fast lookups since it
   requires only a single seek and a single record.
 
-* The begin IP and the actual information is stored in the value,
-  packed using Msgpack like this:
+* The begin IP and the actual information is stored in the value. The
+  value starts with a fixed-size binary header, followed by the raw
+  data blobs:
 
-  * IP begin address
+  * Record format version (a single byte)
+  * IP begin address (16 bytes)
+  * Size of the latest datetime (1 byte)
+  * Size of the latest version JSON data (4 bytes)
+  * Size of the history data (4 bytes), which is zero if there is none
+  * Latest datetime (ASCII)
   * JSON encoded data for the latest version
-  * Latest datetime
-  * Msgpack encoded diffs for older versions (yes, Msgpack in Msgpack,
-    since this nested structure is not always needed and lets us decode
-    it explicitly)
+
+  The fixed-size header allows lookups to check the range boundaries and
+  to slice out the latest version without decoding anything.
+
+The history keyspace uses the same keys (the end IP), and stores the
+Msgpack encoded diffs for older versions as the value. Ranges without
+any older versions do not have a history entry at all.
+
+The secondary index maps the values of configured fields (e.g. 'asn') in
+the latest version to the ranges having that value. Each entry is a key
+without a value, consisting of the field name, the value (as text), and
+the end IP of the range, separated by null bytes. Entries for a field
+and value are adjacent, so a query only requires a single seek.
+
+The change log contains an entry for each range that gained a version
+during a load, using the datetime of that version, and the end IP of the
+range as the key (separated by a null byte). Ranges whose boundaries
+changed without gaining a version are logged using the most recent
+datetime in the database. Entries are never updated, so they may refer to
+ranges that no longer exist. While loading, the entries are staged in
+the target slot, and only added to the change log when that slot is
+activated.
+
+A materialised view holds the fully resolved JSON of each range for
+a configured datetime, so that lookups for that datetime are as cheap as
+lookups for the latest version. The key consists of the datetime and the
+end IP of the range (separated by a null byte), and the value contains
+the begin IP (16 bytes), followed by the JSON data. Ranges without
+a version for the datetime do not have an entry.
+
+Older databases store all records without any key prefix, and keep the
+history inside the record value, either using the binary header format
+above, or using a Msgpack encoded array containing the same information
+(begin IP, latest JSON, latest datetime and the Msgpack encoded diffs).
+Lookups can still use these databases, but anything else requires
+converting them first, using Database.migrate().
 
 Note the odd mix of JSON and Msgpack encoding. Encoding/decoding speeds
 are comparable (when using ujson), but Msgpack uses less space and hence
@@ -40,21 +98,35 @@ saves a complete decode/encode (from Msgpack to JSON) roundtrip when
 executing queries asking for the most recent version.
 """
 
+import collections
 import functools
+import hashlib
+import itertools
 import logging
 import operator
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
 
 import msgpack
 from msgpack import loads as msgpack_loads
 import plyvel
 
+from .coverage import Coverage
+from .delta import DeltaWriter, iter_diff, read_delta
 from .json import dumps as json_dumps, loads as json_loads
+from .memory import MemoryIndex
+from .pipeline import BackgroundWriter, format_utilisation, Prefetcher
 from .util import (
     dict_diff_incremental,
     dict_patch_incremental,
     ip_packed_to_int,
     ip_int_to_packed,
     ip_int_to_str,
+    ip_packed_to_str,
     ip_str_to_packed,
     merge_ranges,
     PeriodicCallback,
@@ -63,6 +135,93 @@ from .util import (
 
 DATETIME_GETTER = operator.itemgetter('datetime')
 
+FORMAT_VERSION = 3
+LEGACY_RECORD_FORMAT_VERSION = 2
+RECORD_HEADER = struct.Struct('>B16sBII')
+RECORD_HEADER_SIZE = RECORD_HEADER.size
+
+MAX_IP_INT = 2 ** 128 - 1
+
+RECORD_PREFIX = b'r'
+HISTORY_PREFIX = b'h'
+META_PREFIX = b'm'
+INDEX_PREFIX = b'i'
+PENDING_PREFIX = b'p'
+CHANGELOG_PREFIX = b'c'
+VIEW_PREFIX = b'v'
+
+# The records, history, and index keyspaces exist twice, in two 'slots'.
+# The active slot is used for lookups, while loading writes a complete
+# new version of the data into the other slot, and then switches.
+SlotPrefixes = collections.namedtuple(
+    'SlotPrefixes', ['records', 'history', 'index', 'pending', 'views'])
+SLOTS = (
+    SlotPrefixes(
+        RECORD_PREFIX, HISTORY_PREFIX, INDEX_PREFIX, PENDING_PREFIX,
+        VIEW_PREFIX),
+    SlotPrefixes(b'R', b'H', b'I', b'P', b'V'),
+)
+
+FORMAT_VERSION_KEY = b'format-version'
+COVERAGE_IPV4_KEY = b'coverage-ipv4'
+COVERAGE_IPV6_KEY = b'coverage-ipv6'
+GENERATION_KEY = b'generation'
+GENERATION_TIME_KEY = b'generation-time'
+GENERATION_DIGEST_SIZE = 8
+INDEX_FIELDS_KEY = b'index-fields'
+VIEWS_KEY = b'views'
+ACTIVE_SLOT_KEY = b'active-slot'
+CHECKPOINT_KEY = b'checkpoint'
+
+# Metadata describing the state of a specific database (not its data),
+# which is never included in delta files.
+LOCAL_META_KEYS = (ACTIVE_SLOT_KEY, CHECKPOINT_KEY)
+
+WRITE_BATCH_SIZE = 1000
+
+# LevelDB tuning for the supported usage profiles. The 'load' profile
+# is used for (bulk) loading, which only does sequential scans that
+# bypass the block cache, but writes a lot. The 'serve' profile is used
+# for lookups. The 'oneshot' profile is used by short-lived processes
+# doing only a few lookups, which do not benefit from large caches. Note
+# that bloom filters are created when tables are written, so all
+# profiles must agree on the number of bits.
+PROFILES = {
+    'load': dict(
+        write_buffer_size=64 * 1024 * 1024,
+        max_open_files=512,
+        lru_cache_size=32 * 1024 * 1024,
+        bloom_filter_bits=10,
+        fill_cache=False,
+        verify_checksums=False,
+    ),
+    'serve': dict(
+        write_buffer_size=16 * 1024 * 1024,
+        max_open_files=512,
+        lru_cache_size=128 * 1024 * 1024,
+        bloom_filter_bits=10,
+        fill_cache=True,
+        verify_checksums=False,
+    ),
+    'oneshot': dict(
+        write_buffer_size=4 * 1024 * 1024,
+        max_open_files=64,
+        lru_cache_size=8 * 1024 * 1024,
+        bloom_filter_bits=10,
+        fill_cache=True,
+        verify_checksums=False,
+    ),
+}
+READ_OPTIONS = ('fill_cache', 'verify_checksums')
+
+# Autotuning limits: use at most this fraction of physical memory for
+# the block cache, and keep some spare file handles.
+AUTOTUNE_MEMORY_FRACTION = 0.5
+AUTOTUNE_SPARE_OPEN_FILES = 256
+
+DEFAULT_CACHE_SIZE = 128 * 1024
+DEFAULT_VERSION_CACHE_SIZE = 4 * 1024
+
 logger = logging.getLogger(__name__)
 
 msgpack_dumps = msgpack.Packer().pack  # faster than calling .packb()
@@ -72,6 +231,8 @@ msgpack_loads_utf8 = functools.partial(
     use_list=False,
     encoding='UTF-8')
 
+EMPTY_HISTORY_MSGPACK = msgpack_dumps(())
+
 
 def debug_format_dict(d):  # pragma: no cover
     """Formatting function for debugging purposes"""
@@ -89,50 +250,129 @@ def make_squash_key(d):
 
 def build_key_value(begin_ip_int, end_ip_int, latest_json, latest_datetime,
                     history_msgpack):
-    """Build the actual key and value byte strings"""
+    """Build the actual key, value and history byte strings.
+
+    The returned history value is `None` if there are no older versions.
+    """
     key = ip_int_to_packed(end_ip_int)
-    value = msgpack_dumps((
+    latest_datetime = latest_datetime.encode('ascii')
+    if history_msgpack == EMPTY_HISTORY_MSGPACK:
+        history_msgpack = None
+    header = RECORD_HEADER.pack(
+        FORMAT_VERSION,
         ip_int_to_packed(begin_ip_int),
-        latest_json,
-        latest_datetime.encode('ascii'),
-        history_msgpack,
-    ))
-    return key, value
+        len(latest_datetime),
+        len(latest_json),
+        0 if history_msgpack is None else len(history_msgpack))
+    value = b''.join((header, latest_datetime, latest_json))
+    return key, value, history_msgpack
+
+
+def unpack_latest(value):
+    """Obtain the begin IP and the latest version from a record value.
+
+    This returns a ``(begin_ip_packed, latest_json)`` tuple, using only
+    the fixed-size header, without decoding anything.
+    """
+    _, begin_ip_packed, datetime_size, latest_json_size, _ = \
+        RECORD_HEADER.unpack_from(value)
+    offset = RECORD_HEADER_SIZE + datetime_size
+    return begin_ip_packed, value[offset:offset + latest_json_size]
+
+
+class RetentionPolicy(collections.namedtuple('RetentionPolicy', [
+        'max_versions',
+        'min_datetime',
+        'monthly_before'])):
+    """
+    Retention policy for historical versions.
+
+    * `max_versions`: keep at most this many versions (including the
+      latest version).
+
+    * `min_datetime`: drop versions that were superseded by a newer
+      version at or before this datetime. Lookups for this datetime (or
+      any later datetime) are not affected.
+
+    * `monthly_before`: for versions before this datetime, only keep the
+      last version in each month, i.e. the one valid at the end of the
+      month.
+
+    All settings are optional. The latest version is always kept.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, max_versions=None, min_datetime=None,
+                monthly_before=None):
+        return super().__new__(cls, max_versions, min_datetime, monthly_before)
+
+    def __bool__(self):
+        return any(x is not None for x in self)
+
+    def apply(self, versions):
+        """Apply this policy to a list of versions (newest first)."""
+        if self.monthly_before is not None:
+            kept = []
+            previous_month = None
+            for d in versions:
+                month = d['datetime'][:7]
+                if d['datetime'] >= self.monthly_before \
+                        or month != previous_month:
+                    kept.append(d)
+                previous_month = month
+            versions = kept
+
+        if self.min_datetime is not None:
+            for idx, d in enumerate(versions):
+                if d['datetime'] <= self.min_datetime:
+                    # This version was valid at the cutoff; anything
+                    # older is not needed.
+                    versions = versions[:idx + 1]
+                    break
 
+        if self.max_versions is not None:
+            versions = versions[:max(self.max_versions, 1)]
 
-def build_history(dicts):
+        return versions
+
+
+def build_history(dicts, retention=None):
     """Build a history structure"""
     dicts.sort(key=DATETIME_GETTER)
     unique_dicts = list(unique_justseen(dicts, key=make_squash_key))
     unique_dicts.reverse()
+    if retention:
+        unique_dicts = retention.apply(unique_dicts)
     latest, diffs_generator = dict_diff_incremental(unique_dicts)
     diffs = list(diffs_generator)
     return latest, diffs
 
 
-def build_record(begin_ip_int, end_ip_int, dicts, existing=None):
-    """Create database records for an iterable of merged dicts."""
+def build_record(dicts, existing=None, retention=None):
+    """Create record data for an iterable of merged dicts.
+
+    This returns a ``(latest_json, latest_datetime, history_msgpack)``
+    tuple, suitable for passing to build_key_value(). If a retention
+    policy is specified, it is applied to the history.
+    """
 
     assert dicts or existing, "no data at all to pack?"
 
-    if not dicts:
+    if not dicts and not (retention and existing.has_history):
         # No new dicts; avoid expensive re-serialisation. Note that
         # blindly reusing the existing key/value pair from the database
         # (by not updating it at all) is not correct: the begin and end
         # of the range may have changed.
-        return build_key_value(
-            begin_ip_int,
-            end_ip_int,
+        return (
             existing.latest_json,
             existing.latest_datetime,
             existing.history_msgpack)
 
     if not existing:
         # Only new dicts, no existing data
-        latest, diffs = build_history(dicts)
-        return build_key_value(
-            begin_ip_int,
-            end_ip_int,
+        latest, diffs = build_history(dicts, retention)
+        return (
             json_dumps(latest, ensure_ascii=False).encode('UTF-8'),
             latest['datetime'],
             msgpack_dumps_utf8(diffs))
@@ -140,7 +380,8 @@ def build_record(begin_ip_int, end_ip_int, dicts, existing=None):
     # At this point we know there is both new data, and an existing
     # record. These need to be merged..
 
-    if min(map(DATETIME_GETTER, dicts)) > existing.latest_datetime:
+    if (not retention and
+            min(map(DATETIME_GETTER, dicts)) > existing.latest_datetime):
         # All new data is newer than the existing record. Take
         # a shortcut by simply prepending the new data to the history
         # chain. This approach prevents quite a lot of overhead from
@@ -151,35 +392,120 @@ def build_record(begin_ip_int, end_ip_int, dicts, existing=None):
     else:
         # Perform a full merge
         dicts.extend(existing.iter_versions())
-        latest, diffs = build_history(dicts)
+        latest, diffs = build_history(dicts, retention)
 
-    return build_key_value(
-        begin_ip_int,
-        end_ip_int,
+    return (
         json_dumps(latest, ensure_ascii=False).encode('UTF-8'),
         latest['datetime'],
         msgpack_dumps_utf8(diffs))
 
 
-class ExistingRecord(object):
+def coalesce_records(records):
+    """
+    Coalesce adjacent records with identical data.
+
+    This generator consumes ``(begin, end, data, existing_key)`` tuples,
+    where `data` is the record data as returned by build_record(), and
+    `existing_key` is the key of the database record at the same end IP
+    (if any). Adjacent ranges with identical data, which includes the
+    complete history, are combined into a single range.
+
+    This yields ``(begin, end, data, obsolete_keys)`` tuples, where
+    `obsolete_keys` is a list of keys of existing database records that
+    are no longer used because of coalescing.
+    """
+    pending = None
+    for begin, end, data, existing_key in records:
+        if pending is not None:
+            pending_begin, pending_end, pending_data, pending_key, \
+                obsolete_keys = pending
+            if begin == pending_end + 1 and data == pending_data:
+                # Extend the pending range; its old end is now obsolete.
+                if pending_key is not None:
+                    obsolete_keys.append(pending_key)
+                pending = (
+                    pending_begin, end, data, existing_key, obsolete_keys)
+                continue
+
+            yield pending_begin, pending_end, pending_data, obsolete_keys
+
+        pending = (begin, end, data, existing_key, [])
+
+    if pending is not None:
+        pending_begin, pending_end, pending_data, _, obsolete_keys = pending
+        yield pending_begin, pending_end, pending_data, obsolete_keys
+
+
+class ExistingRecord(collections.namedtuple('ExistingRecord', [
+        'begin_ip_packed',
+        'end_ip_packed',
+        'latest_json',
+        'latest_datetime',
+        'history_msgpack'])):
     """Helper class for working with records retrieved from the database."""
-    def __init__(self, key, value):
+
+    # Records are created for every range scanned during loading, so
+    # keep them as compact as possible: no per-instance __dict__.
+    __slots__ = ()
+
+    @classmethod
+    def from_key_value(cls, key, value, history_msgpack=None):
+        """Create a record from a raw database key/value pair.
+
+        The history is stored separately. If the record has older
+        versions, the `history_msgpack` value must be passed explicitly
+        before iter_versions() can be used.
+        """
         # Performance note: except for the initial value unpacking, all
         # expensive deserialization operations are deferred until
         # requested.
-        unpacked = msgpack_loads(value, use_list=False)
-
-        # IP addresses
-        self.begin_ip_packed = unpacked[0]
-        self.end_ip_packed = key
-
-        # Actual data, without any expensive decoding applied
-        self.latest_json = unpacked[1]
-        self.latest_datetime = unpacked[2].decode('ascii')
-        self.history_msgpack = unpacked[3]
+        _, begin_ip_packed, datetime_size, latest_json_size, history_size = \
+            RECORD_HEADER.unpack_from(value)
+        latest_json_offset = RECORD_HEADER_SIZE + datetime_size
+        if not history_size:
+            history_msgpack = EMPTY_HISTORY_MSGPACK
+        return cls(
+            begin_ip_packed,
+            key,
+            value[latest_json_offset:latest_json_offset + latest_json_size],
+            value[RECORD_HEADER_SIZE:latest_json_offset].decode('ascii'),
+            history_msgpack)
+
+    @classmethod
+    def from_legacy_key_value(cls, key, value):
+        """Create a record from a key/value pair in a legacy format."""
+        if value[0] == LEGACY_RECORD_FORMAT_VERSION:
+            # Binary header, followed by the datetime, the latest version
+            # and the (inline) history
+            _, begin_ip_packed, datetime_size, latest_json_size, _ = \
+                RECORD_HEADER.unpack_from(value)
+            latest_json_offset = RECORD_HEADER_SIZE + datetime_size
+            history_offset = latest_json_offset + latest_json_size
+            return cls(
+                begin_ip_packed,
+                key,
+                value[latest_json_offset:history_offset],
+                value[RECORD_HEADER_SIZE:latest_json_offset].decode('ascii'),
+                value[history_offset:])
+
+        # Msgpack encoded array
+        begin_ip_packed, latest_json, latest_datetime, history_msgpack = \
+            msgpack_loads(value, use_list=False)
+        return cls(
+            begin_ip_packed,
+            key,
+            latest_json,
+            latest_datetime.decode('ascii'),
+            history_msgpack)
+
+    @property
+    def has_history(self):
+        """Whether this record contains any older versions."""
+        return self.history_msgpack != EMPTY_HISTORY_MSGPACK
 
     def iter_versions(self, inplace=False):
         """Lazily reconstruct all versions in this record."""
+        assert self.history_msgpack is not None, "history not available"
 
         # Latest version
         latest = json_loads(self.latest_json)
@@ -192,95 +518,1074 @@ class ExistingRecord(object):
             inplace=inplace)
 
 
+def version_json(record, datetime):
+    """Obtain the version of a record for a datetime, as JSON.
+
+    The history of the record must be available. This returns `None` if
+    there is no version for the datetime.
+    """
+    # The most recent version may be the one asked for. No decoding
+    # required in that case.
+    if record.latest_datetime <= datetime:
+        return record.latest_json
+
+    # Iteratively apply patches until (hopefully) a match is found.
+    for d in record.iter_versions(inplace=True):
+        if d['datetime'] <= datetime:
+            return json_dumps(d, ensure_ascii=False).encode('UTF-8')
+
+    return None
+
+
+class RecordVersions(object):
+    """
+    All versions of a record, decoded once for repeated lookups.
+
+    The JSON encoding of each version is memoised, so that all lookups
+    resolving to the same version return the same byte string without
+    any decoding or encoding.
+    """
+
+    __slots__ = ('versions', 'datetimes', 'encoded', 'history_json')
+
+    def __init__(self, record):
+        self.versions = list(record.iter_versions())
+        self.datetimes = [d['datetime'] for d in self.versions]
+        self.encoded = [record.latest_json]
+        self.encoded.extend([None] * (len(self.versions) - 1))
+        self.history_json = None
+
+    def version_json(self, datetime):
+        """Obtain the version for a datetime. See version_json()."""
+        for idx, version_datetime in enumerate(self.datetimes):
+            if version_datetime <= datetime:
+                encoded = self.encoded[idx]
+                if encoded is None:
+                    encoded = json_dumps(
+                        self.versions[idx], ensure_ascii=False).encode('UTF-8')
+                    self.encoded[idx] = encoded
+                return encoded
+        return None
+
+    def all_json(self):
+        """Obtain all versions (see Database.lookup())."""
+        if self.history_json is None:
+            # The JSON response is an object (not a list) for security
+            # reasons.
+            self.history_json = json_dumps(
+                {'history': self.versions}, ensure_ascii=False,
+            ).encode('UTF-8')
+        return self.history_json
+
+
+def build_view_entries(view_datetimes, record):
+    """Build the materialised view entries for a record."""
+    for datetime in view_datetimes:
+        info_as_json = version_json(record, datetime)
+        if info_as_json is not None:
+            yield (
+                build_view_key(datetime, record.end_ip_packed),
+                record.begin_ip_packed + info_as_json)
+
+
+def iter_version_datetimes(latest_datetime, history_msgpack):
+    """Iterate over the datetimes of all versions in a record.
+
+    This only decodes the history, without reconstructing any versions.
+    """
+    yield latest_datetime
+    for modifications, _ in msgpack_loads_utf8(history_msgpack):
+        if 'datetime' in modifications:
+            yield modifications['datetime']
+
+
+def skip_ranges(iterable, last_end):
+    """Skip (parts of) ranges up to and including `last_end`."""
+    for begin, end, data in iterable:
+        if end <= last_end:
+            continue
+        yield max(begin, last_end + 1), end, data
+
+
+def build_view_key(datetime, key=b''):
+    """Build a materialised view key (or prefix, if `key` is empty)."""
+    return datetime.encode('ascii') + b'\0' + key
+
+
+def index_value_text(value):
+    """Convert a field value to text for use in the secondary index.
+
+    Only scalar values are indexed; this returns `None` for others.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bool, int, float)):
+        return json_dumps(value)
+    return None
+
+
+def build_index_key(field, value_text, key=b''):
+    """Build a secondary index key (or prefix, if `key` is empty)."""
+    return b''.join((
+        field.encode('UTF-8'), b'\0',
+        value_text.encode('UTF-8'), b'\0',
+        key))
+
+
+def build_index_keys(fields, key, latest_json):
+    """Build the secondary index keys for a record."""
+    if not fields:
+        return set()
+    d = json_loads(latest_json)
+    index_keys = set()
+    for field in fields:
+        value_text = index_value_text(d.get(field))
+        if value_text is not None and '\0' not in value_text:
+            index_keys.add(build_index_key(field, value_text, key))
+    return index_keys
+
+
+def format_range_json(begin_ip, end_ip, info_as_json):
+    """Format a scan() result as a JSON object (a byte string).
+
+    The JSON encoded information is included without decoding it.
+    """
+    return b''.join((
+        b'{"begin":"', begin_ip.encode('ascii'),
+        b'","end":"', end_ip.encode('ascii'),
+        b'","info":', info_as_json, b'}'))
+
+
+def autotune_options(database_dir):
+    """Determine LevelDB options based on the database size on disk.
+
+    The block cache is sized to hold the complete database, limited by
+    the amount of physical memory, and enough file handles are allowed
+    to keep all table files open.
+    """
+    n_files = 0
+    size = 0
+    if os.path.isdir(database_dir):
+        for entry in os.scandir(database_dir):
+            if entry.name.endswith(('.ldb', '.sst')):
+                n_files += 1
+                size += entry.stat().st_size
+
+    options = dict(max_open_files=n_files + AUTOTUNE_SPARE_OPEN_FILES)
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):  # pragma: no cover
+        memory = None
+    if memory is not None:
+        options['lru_cache_size'] = max(
+            PROFILES['serve']['lru_cache_size'],
+            min(size, int(memory * AUTOTUNE_MEMORY_FRACTION)))
+
+    logger.info(
+        "Autotuned options for %d table files (%d MB): %r",
+        n_files, size // (1024 * 1024), options)
+    return options
+
+
 class Database(object):
     """
     Database access class for loading and looking up data.
+
+    The LevelDB options and read options are taken from the specified
+    profile (see PROFILES). Any of these can be overridden using keyword
+    arguments; `None` values are ignored, so compression is disabled
+    using ``compression='none'``. If `autotune` is enabled, the
+    cache size and number of open files are determined automatically
+    based on the database size (see autotune_options()), unless
+    overridden explicitly.
+
+    Lookup results are kept in a cache holding at most `cache_size`
+    entries. Since lookups for different datetimes often resolve to the
+    same version, the decoded versions of at most `version_cache_size`
+    records are cached as well (see RecordVersions). If `in_memory` is
+    enabled, latest version lookups use an in-memory index (see
+    MemoryIndex) instead of the database. If `use_coverage` is disabled,
+    coverage information is not loaded, which makes opening the
+    database much faster, but lookups for addresses in gaps slower; this
+    is useful for short-lived processes.
+
+    Databases using an older storage format (see the module
+    documentation) can be used for (slower) lookups, but other
+    operations raise RuntimeError until migrate() has converted them.
+    Opening such a database logs a warning, unless `check_format` is
+    disabled.
+
+    Concurrency model: lookup() is thread-safe. Each thread uses its own
+    LevelDB iterator, since iterators are stateful and cannot be
+    shared, and the lookup cache is safe for concurrent use. Loading
+    (and other methods that write to the database) must not run
+    concurrently with other operations. Afterwards, all threads
+    transparently switch to new iterators so that new data is seen.
     """
 
-    def __init__(self, database_dir, create_if_missing=False):
+    def __init__(self, database_dir, create_if_missing=False,
+                 check_format=True, profile='serve', autotune=False,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 version_cache_size=DEFAULT_VERSION_CACHE_SIZE,
+                 in_memory=False, use_coverage=True, **options):
         logger.debug("Opening database %s", database_dir)
+
+        db_options = dict(PROFILES[profile])
+        if autotune:
+            db_options.update(autotune_options(database_dir))
+        db_options.update(
+            (k, v) for k, v in options.items() if v is not None)
+        if db_options.get('compression') == 'none':
+            db_options['compression'] = None
+        self.read_options = {
+            name: db_options.pop(name) for name in READ_OPTIONS}
+        logger.debug("Database options: %r", db_options)
+
         self.db = plyvel.DB(
             database_dir,
             create_if_missing=create_if_missing,
-            write_buffer_size=16 * 1024 * 1024,
-            max_open_files=512,
-            lru_cache_size=128 * 1024 * 1024)
-        self.iter = None
+            **db_options)
+        self.meta = self.db.prefixed_db(META_PREFIX)
+        self.changelog = self.db.prefixed_db(CHANGELOG_PREFIX)
+        self._open_slot(int(self.meta.get(ACTIVE_SLOT_KEY, b'0')))
+
+        # Per-thread iterators for lookups. The epoch is incremented
+        # whenever the database changes, which invalidates all iterators.
+        self._local = threading.local()
+        self._iter_epoch = 0
+
+        # Per-instance lookup cache (the cache is thread-safe)
+        self.lookup = functools.lru_cache(cache_size)(self._lookup)
+        self._get_versions = functools.lru_cache(version_cache_size)(
+            self._load_versions)
+
+        self.format_version = self._detect_format_version()
+        if self.format_version is None:
+            # Older databases store records without any key prefix.
+            self.records = self.db
+            if check_format:
+                logger.warning(
+                    "Database %r uses an old storage format; "
+                    "run 'whip-cli migrate' to convert it", database_dir)
+
+        self.coverage = None
+        if use_coverage and self.format_version == FORMAT_VERSION:
+            self.coverage = self._load_coverage()
+
+        self.generation, self.generation_time = self._load_generation()
+
+        value = self.meta.get(INDEX_FIELDS_KEY)
+        self.index_fields = json_loads(value) if value is not None else []
+        value = self.meta.get(VIEWS_KEY)
+        self.view_datetimes = json_loads(value) if value is not None else []
+
+        self.in_memory = in_memory
+        self.memory_index = None
+        if in_memory and self.format_version == FORMAT_VERSION:
+            self.memory_index = self._build_memory_index()
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+    def _detect_format_version(self):
+        """Detect the storage format used by the database."""
+        value = self.meta.get(FORMAT_VERSION_KEY)
+        if value is not None:
+            return int(value)
+
+        if next(self.db.iterator(include_value=False), None) is None:
+            # Empty database; use the current format.
+            self.meta.put(FORMAT_VERSION_KEY, str(FORMAT_VERSION).encode())
+            return FORMAT_VERSION
+
+        # Records without any key prefix and without a format version
+        # marker; this is a database created by an older version.
+        return None
 
-    def iter_records(self):
+    def _load_coverage(self):
+        """Load coverage information, building it if needed."""
+        ipv4_value = self.meta.get(COVERAGE_IPV4_KEY)
+        ipv6_value = self.meta.get(COVERAGE_IPV6_KEY)
+        if ipv4_value is not None and ipv6_value is not None:
+            return Coverage.from_bytes(ipv4_value, ipv6_value)
+
+        logger.info("Building coverage information")
+        coverage = Coverage()
+        for key, value in self.records.iterator(fill_cache=False):
+            begin_ip_packed, _ = unpack_latest(value)
+            coverage.add(
+                ip_packed_to_int(begin_ip_packed),
+                ip_packed_to_int(key))
+
+        self._store_coverage(coverage)
+        return coverage
+
+    def _store_coverage(self, coverage, wb=None):
+        """Store coverage information."""
+        ipv4_value, ipv6_value = coverage.to_bytes()
+        if wb is None:
+            wb = self.db
+        wb.put(META_PREFIX + COVERAGE_IPV4_KEY, ipv4_value)
+        wb.put(META_PREFIX + COVERAGE_IPV6_KEY, ipv6_value)
+
+    def _load_generation(self):
+        """Load the generation identifier and time (if any)."""
+        generation = self.meta.get(GENERATION_KEY)
+        generation_time = self.meta.get(GENERATION_TIME_KEY)
+        if generation is None or generation_time is None:
+            return None, None
+        return generation.decode('ascii'), int(generation_time)
+
+    def _store_generation(self, digest, wb):
+        """Store a new generation, computed by the specified digest."""
+        self.generation = digest.hexdigest()
+        self.generation_time = int(time.time())
+        wb.put(META_PREFIX + GENERATION_KEY, self.generation.encode('ascii'))
+        wb.put(
+            META_PREFIX + GENERATION_TIME_KEY,
+            str(self.generation_time).encode('ascii'))
+
+    def _build_memory_index(self):
+        """Build an in-memory index from the database contents."""
+        logger.info("Building in-memory index")
+        memory_index = MemoryIndex()
+        for key, value in self.records.iterator(fill_cache=False):
+            begin_ip_packed, latest_json = unpack_latest(value)
+            memory_index.add(begin_ip_packed, key, latest_json)
+        memory_index.finish()
+        return memory_index
+
+    def iter_records(self, start=None):
         """
         Iterate a database and yield records that can be merged with new data.
 
-        This generator is suitable for consumption by merge_ranges().
+        This generator is suitable for consumption by merge_ranges(). If
+        `start` is specified, only ranges ending at or after that IP
+        (specified as an integer) are included.
         """
-        for key, value in self.db.iterator(fill_cache=False):
-            record = ExistingRecord(key, value)
+        if start is not None:
+            start = ip_int_to_packed(start)
+
+        if self.format_version is None:
+            yield from self._iter_legacy_records(start)
+            return
+
+        from_key_value = ExistingRecord.from_key_value
+
+        # History entries use the same keys as the records, so
+        # a single forward scan over both keyspaces suffices.
+        history_iter = self.history.iterator(start=start, fill_cache=False)
+        history_key = b''
+        history_value = None
+
+        for key, value in self.records.iterator(
+                start=start, fill_cache=False):
+            record = from_key_value(key, value)
+            if record.history_msgpack is None:
+                while history_key < key:
+                    history_key, history_value = next(history_iter)
+                assert history_key == key, "history entry missing"
+                record = record._replace(history_msgpack=history_value)
+
             yield (
                 ip_packed_to_int(record.begin_ip_packed),
-                ip_packed_to_int(record.end_ip_packed),
+                ip_packed_to_int(key),
                 record,
             )
 
-    def load(self, *iterables):
-        """Load data from importer iterables"""
+    def _iter_legacy_records(self, start=None):
+        """Iterate over the records of a database using an older format."""
+        from_legacy_key_value = ExistingRecord.from_legacy_key_value
+        for key, value in self.records.iterator(
+                start=start, fill_cache=False):
+            if len(key) != 16:
+                # Written by an interrupted migration
+                continue
+            record = from_legacy_key_value(key, value)
+            yield (
+                ip_packed_to_int(record.begin_ip_packed),
+                ip_packed_to_int(key),
+                record,
+            )
+
+    def _check_format(self):
+        """Refuse operations that require the current storage format."""
+        if self.format_version != FORMAT_VERSION:
+            raise RuntimeError(
+                "Database uses an old storage format; "
+                "run 'whip-cli migrate' to convert it")
+
+    def iter_raw_chunks(self, chunk_size):
+        """
+        Iterate over all records in chunks of consecutive keys.
+
+        This generator yields ``(records, history)`` tuples, containing
+        lists of raw ``(key, value)`` pairs for (at most `chunk_size`)
+        records and their history entries. These can be turned into
+        records using ExistingRecord.from_key_value(). Nothing is
+        decoded, which makes this cheap, e.g. when other processes do
+        the actual work.
+        """
+        self._check_format()
+        records_iter = self.records.iterator(fill_cache=False)
+        while True:
+            records = list(itertools.islice(records_iter, chunk_size))
+            if not records:
+                return
+            history = list(self.history.iterator(
+                start=records[0][0], stop=records[-1][0], include_stop=True,
+                fill_cache=False))
+            yield records, history
+
+    def load(self, *iterables, retention=None, checkpoint=None,
+             resume=False, delta=None):
+        """Load data from importer iterables
+
+        If a retention policy is specified, it is applied to all records
+        in the database.
+
+        Loading writes the new data separately from the current data,
+        which stays available until the load is complete. Progress is
+        checkpointed regularly. If specified, the `checkpoint` callback
+        is called with the end of the last written range (an integer),
+        and may return any JSON serializable information needed to
+        resume reading the iterables, e.g. file offsets; see
+        checkpoint_state(). If `resume` is enabled, an interrupted load
+        (or prune/optimize operation) is continued; the iterables must
+        produce the same data, but may skip anything up to the last
+        written range.
+
+        If `delta` is specified (a binary file like object), a delta
+        file containing the changes is written to it (see
+        apply_delta()). This is not possible when resuming.
+        """
 
-        if not iterables:
+        if not iterables and not resume:
             logger.warning("No new input files; nothing to load")
             return
 
+        if delta is not None and resume:
+            raise ValueError("Cannot write a delta file when resuming")
+
+        self._rewrite(iterables, retention, checkpoint, resume, delta)
+        logger.info("Loading finished")
+
+    def prune(self, retention):
+        """Apply a retention policy to all records in the database."""
+        self._rewrite([], retention)
+        logger.info("Pruning finished")
+
+    def optimize(self):
+        """Optimize the database by coalescing adjacent identical ranges.
+
+        Loading takes care of this as well, so this is only useful for
+        databases created by older versions.
+        """
+        self._rewrite([])
+        logger.info("Optimizing finished")
+
+    def _rewrite(self, iterables, retention=None, checkpoint=None,
+                 resume=False, delta=None):
+        """Merge new data with the current database contents.
+
+        The result is written to the inactive slot, which becomes the
+        active slot afterwards; see load() for the other arguments.
+        """
+        self._check_format()
+        state = self.checkpoint_state()
+        if resume:
+            if state is None:
+                raise RuntimeError("No interrupted load to resume")
+            target_slot = state['slot']
+            last_end = ip_packed_to_int(bytes.fromhex(state['end']))
+            max_datetime = state['max_datetime']
+            if state['retention'] is not None:
+                retention = RetentionPolicy(*state['retention'])
+            logger.info(
+                "Resuming after %s", ip_int_to_str(last_end))
+        else:
+            if state is not None:
+                logger.warning("Discarding data from an interrupted load")
+            target_slot = 1 - self.slot
+            last_end = -1
+            max_datetime = ''
+            self._clear_slot(target_slot)
+        target = SLOTS[target_slot]
+
+        # The shared keyspaces are compared against a snapshot for the
+        # delta file (if any); the previous slot is still available.
+        if delta is not None:
+            snapshot = self.db.snapshot()
+            base_generation = self.generation
+
         # Combine new data with current database contents, and merge all
-        # iterables to produce unique, non-overlapping ranges.
+        # iterables to produce unique, non-overlapping ranges. When
+        # resuming, anything up to the last written range is skipped.
+        # Reading the current database and writing the results happen in
+        # background threads (see the pipeline module).
+        reader = Prefetcher(self.iter_records(
+            start=last_end if resume else None))
+        writer = BackgroundWriter()
+        start_time = time.perf_counter()
         iterables = list(iterables)
-        iterables.append(self.iter_records())
+        iterables.append(reader)
+        if resume:
+            iterables = [skip_ranges(it, last_end) for it in iterables]
         merged = merge_ranges(*iterables)
 
         # Progress/status tracking
-        n_processed = n_updated = 0
+        n_processed = n_updated = n_written = 0
         begin_ip_int = 0
         reporter = PeriodicCallback(lambda: logger.info(
-            "%d ranges processed (%d updated, %d new); current position %s",
-            n_processed, n_updated, n_processed - n_updated,
-            ip_int_to_str(begin_ip_int)))
+            "%d ranges processed (%d updated, %d new), %d records written; "
+            "current position %s; stage utilisation: %s",
+            n_processed, n_updated, n_processed - n_updated, n_written,
+            ip_int_to_str(begin_ip_int),
+            format_utilisation(
+                time.perf_counter() - start_time, reader, writer)))
         reporter.tick()
 
-        # Loop over current database and new data
-        for begin_ip_int, end_ip_int, items in merged:
-            if n_processed % 100 == 0:
-                reporter.tick()
+        # Change tracking for each merged range, in order: the end, the
+        # datetimes of the versions it gained, and the boundaries of the
+        # existing range (if any). Entries are consumed when records are
+        # written, which may combine multiple merged ranges.
+        changes = collections.deque()
+
+        def iter_merged_records():
+            nonlocal n_processed, n_updated, begin_ip_int
+
+            for begin_ip_int, end_ip_int, items in merged:
+                if n_processed % 100 == 0:
+                    reporter.tick()
+
+                # Find and pop existing record (if any) from the list.
+                existing = None
+                for idx, item in enumerate(items):
+                    if isinstance(item, ExistingRecord):
+                        existing = item
+                        del items[idx]
+                        break
+
+                # Build a new record
+                data = build_record(items, existing, retention)
+
+                # Track changes. Any new versions have new datetimes.
+                if existing is None:
+                    changes.append((
+                        end_ip_int, set(iter_version_datetimes(*data[1:])),
+                        None))
+                else:
+                    gained = ()
+                    existing_data = (
+                        existing.latest_json,
+                        existing.latest_datetime,
+                        existing.history_msgpack)
+                    if data != existing_data:
+                        gained = set(iter_version_datetimes(*data[1:]))
+                        gained.difference_update(
+                            iter_version_datetimes(*existing_data[1:]))
+                    changes.append((
+                        end_ip_int, gained,
+                        (ip_packed_to_int(existing.begin_ip_packed),
+                         ip_packed_to_int(existing.end_ip_packed))))
+
+                # The target slot starts out empty, so there are no
+                # existing keys to take care of.
+                yield begin_ip_int, end_ip_int, data, None
+
+                # Update counters
+                n_processed += 1
+                if existing is not None:
+                    n_updated += 1
+
+        def write_checkpoint(last_key):
+            inputs = None
+            if checkpoint is not None:
+                inputs = checkpoint(ip_packed_to_int(last_key))
+            wb.put(META_PREFIX + CHECKPOINT_KEY, json_dumps({
+                'slot': target_slot,
+                'end': last_key.hex(),
+                'max_datetime': max_datetime,
+                'retention': list(retention) if retention else None,
+                'inputs': inputs,
+            }).encode('UTF-8'))
+
+        # Loop over current database and new data, and store the new
+        # records in the target slot. Adjacent ranges with identical data
+        # are combined into a single record. Each batch contains
+        # a checkpoint, so that an interrupted load can be resumed.
+        # Change log entries are staged in the target slot, and only
+        # added to the change log when the slot is activated. For ranges
+        # with changed boundaries (an empty value), the datetime to use
+        # is not known in advance anyway.
+        # The coverage and generation digest include any records written
+        # before the load was interrupted.
+        if resume:
+            coverage, digest = self._scan_slot(target_slot)
+        else:
+            coverage = Coverage()
+            digest = hashlib.blake2b(digest_size=GENERATION_DIGEST_SIZE)
+        index_fields = self.index_fields
+        view_datetimes = self.view_datetimes
+        wb = self.db.write_batch()
+        key = None
+        records = coalesce_records(iter_merged_records())
+        try:
+            for begin, end, data, _ in records:
+                key, value, history_value = build_key_value(begin, end, *data)
+                wb.put(target.records + key, value)
+                digest.update(key)
+                digest.update(value)
+                if history_value is not None:
+                    wb.put(target.history + key, history_value)
+                    digest.update(history_value)
+                coverage.add(begin, end)
+
+                gained = set()
+                boundary_changed = False
+                while changes and changes[0][0] <= end:
+                    _, piece_gained, existing_range = changes.popleft()
+                    gained.update(piece_gained)
+                    if existing_range not in (None, (begin, end)):
+                        boundary_changed = True
+                if gained:
+                    wb.put(target.pending + key, b'\0'.join(
+                        datetime.encode('ascii')
+                        for datetime in sorted(gained)))
+                elif boundary_changed:
+                    wb.put(target.pending + key, b'')
+                max_datetime = max(max_datetime, data[1])
+
+                for index_key in build_index_keys(index_fields, key, data[0]):
+                    wb.put(target.index + index_key, b'')
+
+                if view_datetimes:
+                    record = ExistingRecord(
+                        ip_int_to_packed(begin), key, *data)
+                    for view_key, view_value in build_view_entries(
+                            view_datetimes, record):
+                        wb.put(target.views + view_key, view_value)
+
+                n_written += 1
+                if n_written % WRITE_BATCH_SIZE == 0:
+                    write_checkpoint(key)
+                    writer.write(wb)
+                    wb = self.db.write_batch()
+
+            if key is not None:
+                write_checkpoint(key)
+            writer.write(wb)
+        finally:
+            reader.close()
+            writer.close()
+        reporter.tick(True)
 
-            # Find and pop existing record (if any) from the list.
-            existing = None
-            for idx, item in enumerate(items):
-                if isinstance(item, ExistingRecord):
-                    existing = item
-                    del items[idx]
-                    break
+        # Everything has been written, so activate the target slot. The
+        # staged change log entries are added in the same batch, so that
+        # the change log never lists changes that are not in use.
+        wb = self.db.write_batch()
+        pending = self.db.prefixed_db(target.pending)
+        for key, value in pending.iterator(fill_cache=False):
+            datetimes = value.split(b'\0') if value else [
+                max_datetime.encode('ascii')]
+            for datetime in datetimes:
+                wb.put(CHANGELOG_PREFIX + datetime + b'\0' + key, b'')
+        wb.put(META_PREFIX + ACTIVE_SLOT_KEY, str(target_slot).encode())
+        wb.delete(META_PREFIX + CHECKPOINT_KEY)
+        self._store_coverage(coverage, wb)
+        self._store_generation(digest, wb)
+        wb.write()
+        self._open_slot(target_slot)
+
+        # The staged entries are not needed anymore. Any leftovers are
+        # harmless: the slot is cleared before it is written again.
+        wb = self.db.write_batch()
+        for n, key in enumerate(
+                pending.iterator(include_value=False, fill_cache=False), 1):
+            wb.delete(target.pending + key)
+            if n % WRITE_BATCH_SIZE == 0:
+                wb.write()
+                wb.clear()
+        wb.write()
+        self.coverage = coverage
+        self._invalidate()
+
+        if delta is not None:
+            self._write_delta(
+                delta, 1 - target_slot, snapshot, base_generation)
+            snapshot.close()
+
+        # Remove the previous data.
+        self._clear_slot(1 - target_slot)
+
+        self._compact()
+
+    def _write_delta(self, fp, old_slot, snapshot, base_generation):
+        """Write the changes since the previous generation to a delta file.
+
+        The previous generation consists of the data in the old slot,
+        and the shared keyspaces as seen by `snapshot`.
+        """
+        logger.info("Writing delta file")
+        writer = DeltaWriter(fp, base_generation, self.generation)
+        for keyspace in ('records', 'history', 'index', 'views'):
+            old = self.db.prefixed_db(getattr(SLOTS[old_slot], keyspace))
+            new = self.db.prefixed_db(getattr(SLOTS[self.slot], keyspace))
+            writer.write(keyspace, iter_diff(
+                old.iterator(fill_cache=False),
+                new.iterator(fill_cache=False)))
+
+        for keyspace, prefix in [
+                ('changelog', CHANGELOG_PREFIX), ('meta', META_PREFIX)]:
+            changes = iter_diff(
+                ((key[1:], value) for key, value in snapshot.iterator(
+                    prefix=prefix, fill_cache=False)),
+                ((key[1:], value) for key, value in self.db.iterator(
+                    prefix=prefix, fill_cache=False)))
+            if keyspace == 'meta':
+                changes = (
+                    change for change in changes
+                    if change[0] not in LOCAL_META_KEYS)
+            writer.write(keyspace, changes)
+
+        writer.close()
+        logger.info("Wrote %d changes to delta file", writer.n_changes)
+
+    def apply_delta(self, fp):
+        """Apply a delta file written while loading (see load()).
+
+        The database must contain the generation the delta file was
+        based on, e.g. a copy of the database it was written for. The
+        complete file is checked before anything is written, so invalid
+        or incomplete files (which raise ValueError) leave the database
+        unchanged. The changes are written in batches, and the new
+        generation is stored last, so that applying can simply be
+        restarted if it was interrupted.
+        """
+        self._check_format()
+
+        # The file is read twice, so non-seekable input (e.g. a pipe) is
+        # copied to a temporary file first.
+        if not fp.seekable():
+            spooled = tempfile.TemporaryFile()
+            shutil.copyfileobj(fp, spooled)
+            spooled.seek(0)
+            fp = spooled
+
+        start = fp.tell()
+        header, changes = read_delta(fp)
+        if header['base'] != self.generation:
+            raise ValueError(
+                "Delta file applies to generation {}, not {}".format(
+                    header['base'], self.generation))
+        logger.info("Checking delta file")
+        collections.deque(changes, maxlen=0)  # Raises for invalid files
+        fp.seek(start)
+        header, changes = read_delta(fp)
+
+        logger.info("Applying delta file for generation %s",
+                    header['generation'])
+        prefixes = SLOTS[self.slot]
+        wb = self.db.write_batch()
+        meta_changes = []
+        n = 0
+        for n, (keyspace, key, value) in enumerate(changes, 1):
+            if keyspace == 'meta':
+                meta_changes.append((META_PREFIX + key, value))
+                continue
+            if keyspace == 'changelog':
+                key = CHANGELOG_PREFIX + key
+            else:
+                key = getattr(prefixes, keyspace) + key
+            if value is None:
+                wb.delete(key)
+            else:
+                wb.put(key, value)
+            if n % WRITE_BATCH_SIZE == 0:
+                wb.write()
+                wb.clear()
+
+        for key, value in meta_changes:
+            if value is None:
+                wb.delete(key)
+            else:
+                wb.put(key, value)
+        wb.write()
+
+        # Unlike after loading, compaction is left to LevelDB, so that
+        # the time needed depends on the size of the changes only.
+        self.coverage = self._load_coverage()
+        self.generation, self.generation_time = self._load_generation()
+        value = self.meta.get(INDEX_FIELDS_KEY)
+        self.index_fields = json_loads(value) if value is not None else []
+        value = self.meta.get(VIEWS_KEY)
+        self.view_datetimes = json_loads(value) if value is not None else []
+        self._invalidate()
+        logger.info("Applied %d changes", n)
+
+    def _compact(self):
+        """Compact the database, getting rid of deleted data."""
+        logger.info("Compacting database... (this may take a while)")
 
-            # Build and store a new record
-            key, value = build_record(
-                begin_ip_int,
-                end_ip_int,
-                items,
-                existing)
-            self.db.put(key, value)
+        # Without explicit bounds, LevelDB does not reliably compact
+        # the deleted data away. All keys are at most 17 bytes.
+        self.db.compact_range(start=b'\x00', stop=b'\xff' * 18)
 
-            # Update counters
-            n_processed += 1
-            if existing is not None:
-                n_updated += 1
+    def checkpoint_state(self):
+        """Return the checkpoint of an interrupted load (or `None`).
 
+        This is a dict, where 'inputs' contains the information returned
+        by the `checkpoint` callback passed to load().
+        """
+        value = self.meta.get(CHECKPOINT_KEY)
+        if value is None:
+            return None
+        return json_loads(value)
+
+    def _open_slot(self, slot):
+        """Use the keyspaces of the specified slot for lookups."""
+        self.slot = slot
+        prefixes = SLOTS[slot]
+        self.records = self.db.prefixed_db(prefixes.records)
+        self.history = self.db.prefixed_db(prefixes.history)
+        self.index = self.db.prefixed_db(prefixes.index)
+        self.views = self.db.prefixed_db(prefixes.views)
+
+    def _clear_slot(self, slot):
+        """Delete all data in the keyspaces of the specified slot."""
+        wb = self.db.write_batch()
+        n = 0
+        for prefix in SLOTS[slot]:
+            it = self.db.iterator(
+                prefix=prefix, include_value=False, fill_cache=False)
+            for n, key in enumerate(it, n + 1):
+                wb.delete(key)
+                if n % WRITE_BATCH_SIZE == 0:
+                    wb.write()
+                    wb.clear()
+        wb.write()
+        if n:
+            logger.info("Removed %d entries from inactive slot", n)
+
+    def _scan_slot(self, slot):
+        """Compute the coverage and generation digest for a slot.
+
+        This computes the same information as _rewrite() does while
+        writing, e.g. for resuming a load.
+        """
+        prefixes = SLOTS[slot]
+        coverage = Coverage()
+        digest = hashlib.blake2b(digest_size=GENERATION_DIGEST_SIZE)
+        history_iter = self.db.prefixed_db(prefixes.history).iterator(
+            fill_cache=False)
+        records = self.db.prefixed_db(prefixes.records)
+        for key, value in records.iterator(fill_cache=False):
+            begin_ip_packed, history_size = \
+                RECORD_HEADER.unpack_from(value)[1::3]
+            coverage.add(ip_packed_to_int(begin_ip_packed),
+                         ip_packed_to_int(key))
+            digest.update(key)
+            digest.update(value)
+            if history_size:
+                history_key, history_value = next(history_iter)
+                assert history_key == key, "history entry mismatch"
+                digest.update(history_value)
+        return coverage, digest
+
+    def set_index_fields(self, fields):
+        """Configure the fields in the secondary index, and rebuild it.
+
+        Afterwards, loading keeps the index up to date. An empty list of
+        fields removes the index.
+        """
+        self._check_format()
+        fields = list(fields)
+        n_processed = 0
+        reporter = PeriodicCallback(lambda: logger.info(
+            "%d records indexed", n_processed))
+
+        prefixes = SLOTS[self.slot]
+
+        # Disable the index while it is being rebuilt, so that an
+        # interrupted rebuild does not leave a partial index in use.
+        self.meta.put(INDEX_FIELDS_KEY, json_dumps([]).encode('UTF-8'))
+        self.index_fields = []
+
+        wb = self.db.write_batch()
+        for n, index_key in enumerate(self.index.iterator(
+                include_value=False, fill_cache=False), 1):
+            wb.delete(prefixes.index + index_key)
+            if n % WRITE_BATCH_SIZE == 0:
+                wb.write()
+                wb.clear()
+        wb.write()
+        wb.clear()
+
+        if fields:
+            logger.info("Building secondary index for fields %r", fields)
+            for key, value in self.records.iterator(fill_cache=False):
+                _, latest_json = unpack_latest(value)
+                for index_key in build_index_keys(fields, key, latest_json):
+                    wb.put(prefixes.index + index_key, b'')
+
+                n_processed += 1
+                if n_processed % WRITE_BATCH_SIZE == 0:
+                    wb.write()
+                    wb.clear()
+                    reporter.tick()
+
+        wb.put(
+            META_PREFIX + INDEX_FIELDS_KEY,
+            json_dumps(fields).encode('UTF-8'))
+        wb.write()
+        self.index_fields = fields
         reporter.tick(True)
 
-        logger.info("Compacting database... (this may take a while)")
-        self.db.compact_range(start=b'\x00' * 16, stop=b'\xff' * 16)
+        self._compact()
 
-        # Force lookups to use a new iterator so new data is seen.
-        self.iter = None
+    def set_view_datetimes(self, datetimes):
+        """Configure the materialised views, and build any new views.
 
-        logger.info("Loading finished")
+        Afterwards, loading keeps the views up to date, and lookups for
+        these datetimes transparently use them. Existing views for other
+        datetimes are removed.
+        """
+        self._check_format()
+        datetimes = sorted(set(datetimes))
+        if 'all' in datetimes:
+            raise ValueError("A view cannot contain all versions")
+        for datetime in datetimes:
+            build_view_key(datetime)  # Raises for non-ASCII datetimes
+        new_datetimes = [
+            datetime for datetime in datetimes
+            if datetime not in self.view_datetimes]
+        n_processed = 0
+        reporter = PeriodicCallback(lambda: logger.info(
+            "%d records processed", n_processed))
+
+        prefixes = SLOTS[self.slot]
+
+        # Disable the views that change, so that an interrupted change
+        # does not leave a partial view in use. Existing views are kept.
+        kept = [
+            datetime for datetime in self.view_datetimes
+            if datetime in datetimes]
+        self.meta.put(VIEWS_KEY, json_dumps(kept).encode('UTF-8'))
+        self.view_datetimes = kept
+
+        # Remove all other entries, including those of partial views.
+        wb = self.db.write_batch()
+        kept_prefixes = tuple(map(build_view_key, kept))
+        it = self.views.iterator(include_value=False, fill_cache=False)
+        for n, view_key in enumerate(it, 1):
+            if not view_key.startswith(kept_prefixes):
+                wb.delete(prefixes.views + view_key)
+            if n % WRITE_BATCH_SIZE == 0:
+                wb.write()
+                wb.clear()
+        wb.write()
+        wb.clear()
+
+        if new_datetimes:
+            logger.info("Building views for datetimes %r", new_datetimes)
+            for _, _, record in self.iter_records():
+                for view_key, view_value in build_view_entries(
+                        new_datetimes, record):
+                    wb.put(prefixes.views + view_key, view_value)
+
+                n_processed += 1
+                if n_processed % WRITE_BATCH_SIZE == 0:
+                    wb.write()
+                    wb.clear()
+                    reporter.tick()
+
+        wb.put(META_PREFIX + VIEWS_KEY, json_dumps(datetimes).encode('UTF-8'))
+        wb.write()
+        self.view_datetimes = datetimes
+        self._invalidate()
+        reporter.tick(True)
+
+        self._compact()
 
-    @functools.lru_cache(128 * 1024)
-    def lookup(self, ip, datetime=None):
+    def migrate(self):
+        """Convert a database created by an older version of Whip.
+
+        The conversion is done in place, and can safely be restarted if
+        it was interrupted.
+        """
+        if self.format_version == FORMAT_VERSION:
+            logger.info("Database already uses the current format")
+            return
+
+        n_processed = 0
+        reporter = PeriodicCallback(lambda: logger.info(
+            "%d records converted", n_processed))
+        reporter.tick()
+
+        # Legacy records use 16 byte keys without any prefix. The
+        # iterator does not see any writes, so records can safely be
+        # rewritten while iterating.
+        prefixes = SLOTS[self.slot]
+        wb = self.db.write_batch()
+        for key, value in self.db.iterator(fill_cache=False):
+            if len(key) != 16:
+                continue
+
+            record = ExistingRecord.from_legacy_key_value(key, value)
+            _, value, history_value = build_key_value(
+                ip_packed_to_int(record.begin_ip_packed),
+                ip_packed_to_int(key),
+                record.latest_json,
+                record.latest_datetime,
+                record.history_msgpack)
+            wb.delete(key)
+            wb.put(prefixes.records + key, value)
+            if history_value is not None:
+                wb.put(prefixes.history + key, history_value)
+
+            n_processed += 1
+            if n_processed % 100 == 0:
+                reporter.tick()
+            if n_processed % WRITE_BATCH_SIZE == 0:
+                wb.write()
+                wb.clear()
+
+        wb.put(META_PREFIX + FORMAT_VERSION_KEY, str(FORMAT_VERSION).encode())
+        wb.write()
+        self.format_version = FORMAT_VERSION
+        self._open_slot(self.slot)
+        reporter.tick(True)
+
+        # The migration may have been restarted, so the coverage and
+        # generation must be computed from the complete database.
+        self.coverage, digest = self._scan_slot(self.slot)
+        self._store_coverage(self.coverage)
+        self._store_generation(digest, self.db)
+
+        self._compact()
+
+        self._invalidate()
+
+        logger.info("Migration finished")
+
+    def _invalidate(self):
+        """Force lookups to use new iterators so that new data is seen."""
+        self._iter_epoch += 1
+        self.lookup.cache_clear()
+        self._get_versions.cache_clear()
+        if self.in_memory:
+            self.memory_index = self._build_memory_index()
+
+    def _get_iterator(self):
+        """Obtain the lookup iterator for the current thread."""
+        local = self._local
+        if getattr(local, 'epoch', None) != self._iter_epoch:
+            local.iter = self.records.iterator(**self.read_options)
+            local.epoch = self._iter_epoch
+        return local.iter
+
+    def _lookup(self, ip, datetime=None):
         """Lookup a single IP address in the database.
 
         This function returns the found information as a JSON byte
@@ -296,36 +1601,146 @@ class Database(object):
         # Pack incoming IP address to a format suitable for lookups.
         ip_packed = ip_str_to_packed(ip)
 
+        # The in-memory index (if any) can answer latest version
+        # lookups on its own.
+        if datetime is None and self.memory_index is not None:
+            return self.memory_index.lookup(ip_packed)
+
+        # Most addresses in gaps can be ruled out without touching the
+        # database at all.
+        coverage = self.coverage
+        if coverage is not None and not coverage.covers(ip_packed):
+            return None
+
+        # Lookups for a datetime having a materialised view do not need
+        # to reconstruct anything.
+        if datetime is not None and datetime in self.view_datetimes:
+            return self._lookup_view(ip_packed, datetime)
+
         # Iterator construction is relatively costly, so reuse it for
         # performance reasons. The iterator won't see any data written
         # after its construction, but that is not a problem since the
-        # data set is static.
-        if self.iter is None:
-            self.iter = self.db.iterator()
+        # data set is static. Iterators are stateful, so each thread
+        # uses its own.
+        it = self._get_iterator()
 
         # The database key stores the end IP of all ranges, so a simple
         # seek positions the iterator at the right key (if found).
-        self.iter.seek(ip_packed)
-        db_record = next(self.iter, None)
+        it.seek(ip_packed)
+        db_record = next(it, None)
 
         # If the seek moved past the last range in the database: no hit
         if db_record is None:
             return None
 
-        # Decode the value
         key, value = db_record
-        record = ExistingRecord(key, value)
+        if self.format_version is None:
+            return self._lookup_legacy(ip_packed, key, value, datetime)
 
-        # Check range boundaries. If the IP currently being looked up is
-        # in a gap, there is no hit after all.
-        if ip_packed < record.begin_ip_packed:
+        # Check the range boundaries using the fixed-size record header,
+        # without building any intermediate objects: most lookups either
+        # miss or ask for the latest version.
+        begin_ip_packed, latest_json = unpack_latest(value)
+
+        # If the IP currently being looked up is in a gap, there is no
+        # hit after all.
+        if ip_packed < begin_ip_packed:
             return None
 
         # If the lookup is for the most recent version, we're done. No
         # decoding required.
+        if datetime is None:
+            return latest_json
+
+        return self._lookup_version(key, value, datetime)
+
+    def lookup_range(self, ip_packed):
+        """Lookup the latest version and the range for a packed address.
+
+        This returns a ``(begin_ip, end_ip, info_as_json)`` tuple, where
+        the addresses are integers, and `info_as_json` is `None` for
+        a gap. The range (or gap) contains the address, but may be
+        smaller than the actual one. Callers can use it to skip lookups
+        for nearby addresses, e.g. when processing sorted addresses.
+        Results are not cached.
+        """
+        ip_int = ip_packed_to_int(ip_packed)
+        if self.memory_index is not None:
+            return ip_int, ip_int, self.memory_index.lookup(ip_packed)
+
+        coverage = self.coverage
+        if coverage is not None and not coverage.covers(ip_packed):
+            return ip_int, ip_int, None
+
+        it = self._get_iterator()
+        it.seek(ip_packed)
+        db_record = next(it, None)
+        if db_record is None:
+            # Past the last range
+            return ip_int, MAX_IP_INT, None
+
+        key, value = db_record
+        if self.format_version is None:
+            return ip_int, ip_int, self._lookup_legacy(
+                ip_packed, key, value, None)
+
+        begin_ip_packed, latest_json = unpack_latest(value)
+        begin_ip_int = ip_packed_to_int(begin_ip_packed)
+        if ip_int < begin_ip_int:
+            # In a gap before this range
+            return ip_int, begin_ip_int - 1, None
+
+        return begin_ip_int, ip_packed_to_int(key), latest_json
+
+    def _lookup_legacy(self, ip_packed, key, value, datetime):
+        """Lookup using a record of a database using an older format.
+
+        This is slow, since the complete record is decoded, but it
+        allows using these databases until they are migrated.
+        """
+        if len(key) != 16:
+            # Written by an interrupted migration
+            return None
+
+        record = ExistingRecord.from_legacy_key_value(key, value)
+        if ip_packed < record.begin_ip_packed:
+            return None
+
         if datetime is None:
             return record.latest_json
 
+        versions = RecordVersions(record)
+        if datetime == 'all':
+            return versions.all_json()
+        return versions.version_json(datetime)
+
+    def _lookup_view(self, ip_packed, datetime):
+        """Lookup a packed IP address in a materialised view."""
+        local = self._local
+        if getattr(local, 'view_epoch', None) != self._iter_epoch:
+            local.view_iter = self.views.iterator(**self.read_options)
+            local.view_epoch = self._iter_epoch
+        it = local.view_iter
+
+        # Like records, view entries use the end IP in the key.
+        prefix = build_view_key(datetime)
+        it.seek(prefix + ip_packed)
+        view_entry = next(it, None)
+        if view_entry is None:
+            return None
+
+        key, value = view_entry
+        if key[:-16] != prefix or ip_packed < value[:16]:
+            return None
+
+        return value[16:]
+
+    def _lookup_version(self, key, value, datetime):
+        """Obtain a specific version (or all versions) from a record.
+
+        See lookup() for the meaning of `datetime`.
+        """
+        record = ExistingRecord.from_key_value(key, value)
         return_history = (datetime == 'all')
 
         # The most recent version may be the one asked for. No decoding
@@ -333,20 +1748,131 @@ class Database(object):
         if not return_history and record.latest_datetime <= datetime:
             return record.latest_json
 
-        # Reconstruct complete history if the query asks for all
-        # historical data. The JSON response is an object (not a list)
-        # for security reasons.
+        # Older versions are needed. Decoding these is relatively
+        # costly, so decoded records are cached. Keys are reused by new
+        # data, so the cache key includes the generation.
+        versions = self._get_versions(key, self.generation)
         if return_history:
-            return json_dumps(
-                {'history': list(record.iter_versions())},
-                ensure_ascii=False,
-            ).encode('UTF-8')
+            return versions.all_json()
+        return versions.version_json(datetime)
 
-        # This is a lookup for a specific timestamp. Iteratively
-        # apply patches until (hopefully) a match is found.
-        for d in record.iter_versions(inplace=True):
-            if d['datetime'] <= datetime:
-                return json_dumps(d, ensure_ascii=False).encode('UTF-8')
+    def _load_versions(self, key, generation):
+        """Decode all versions of a record. See _lookup_version().
 
-        # Too bad, no result
-        return None
+        The `generation` is only used as part of the cache key.
+        """
+        # pylint: disable=unused-argument
+        record = ExistingRecord.from_key_value(
+            key,
+            self.records.get(key, **self.read_options),
+            self.history.get(key, **self.read_options))
+        return RecordVersions(record)
+
+    def _get_latest(self, key):
+        """Obtain the latest version of the range with the specified key.
+
+        This returns a ``(begin_ip, end_ip, info_as_json)`` tuple, or
+        `None` if there is no such range.
+        """
+        value = self.records.get(key, **self.read_options)
+        if value is None:
+            return None
+
+        begin_ip_packed, latest_json = unpack_latest(value)
+        return (
+            ip_packed_to_str(begin_ip_packed),
+            ip_packed_to_str(key),
+            latest_json)
+
+    def find(self, field, value):
+        """Find all ranges having a field value in their latest version.
+
+        This uses the secondary index, which must contain the field (see
+        set_index_fields()). Values are compared as text, so 1234 and
+        '1234' are equivalent.
+
+        This generator yields ``(begin_ip, end_ip, info_as_json)`` tuples
+        in address order, like scan().
+        """
+        if field not in self.index_fields:
+            raise ValueError("Field {!r} is not indexed".format(field))
+
+        value_text = index_value_text(value)
+        if value_text is None:
+            return
+
+        prefix = build_index_key(field, value_text)
+        it = self.index.iterator(
+            prefix=prefix, include_value=False, **self.read_options)
+        for index_key in it:
+            result = self._get_latest(index_key[len(prefix):])
+            assert result is not None, "stale index entry"
+            yield result
+
+    def changes_since(self, datetime, until=None):
+        """Find all ranges that changed after a datetime.
+
+        This uses the change log, and only includes changes after (not
+        at) `datetime`, and at or before `until` (if specified).
+
+        This generator yields ``(begin_ip, end_ip, info_as_json)`` tuples
+        for the latest version of each changed range, ordered by the
+        datetime of the (first) change.
+        """
+        self._check_format()
+
+        # The null byte separator sorts before any other byte, so these
+        # bounds sort directly after all entries for the datetimes, and
+        # before entries for longer datetimes with the same prefix.
+        start = datetime.encode('ascii') + b'\x01'
+        stop = None
+        if until is not None:
+            stop = until.encode('ascii') + b'\x01'
+
+        seen = set()
+        it = self.changelog.iterator(
+            start=start, stop=stop, include_value=False, **self.read_options)
+        for changelog_key in it:
+            key = changelog_key[-16:]
+            if key in seen:
+                continue
+            seen.add(key)
+
+            # The range may no longer exist, e.g. after coalescing.
+            result = self._get_latest(key)
+            if result is not None:
+                yield result
+
+    def scan(self, begin_ip, end_ip, datetime=None):
+        """Iterate over all ranges overlapping an IP address range.
+
+        This generator yields ``(begin_ip, end_ip, info_as_json)`` tuples
+        in address order, where the IP addresses are strings, and the
+        information is a JSON byte string, as returned by lookup(). The
+        ranges are not clipped to the requested range. Ranges without
+        information for the requested `datetime` are skipped.
+        """
+        self._check_format()
+        end_ip_packed = ip_str_to_packed(end_ip)
+
+        # Like lookups, a single seek finds the first range, since keys
+        # contain the end IP. Since this is a generator, it cannot use
+        # the per-thread lookup iterator.
+        it = self.records.iterator(
+            start=ip_str_to_packed(begin_ip), **self.read_options)
+        for key, value in it:
+            begin_ip_packed, latest_json = unpack_latest(value)
+            if begin_ip_packed > end_ip_packed:
+                break
+
+            if datetime is None:
+                info_as_json = latest_json
+            else:
+                info_as_json = self._lookup_version(key, value, datetime)
+                if info_as_json is None:
+                    continue
+
+            yield (
+                ip_packed_to_str(begin_ip_packed),
+                ip_packed_to_str(key),
+                info_as_json)
@@ -0,0 +1,126 @@
+"""
+Whip delta module.
+
+A delta file contains the changes between two generations of
+a database, so that copies of the database (e.g. on serving replicas)
+can be updated without transferring the complete database. Deltas are
+written while loading (see Database.load()), and applied using
+Database.apply_delta().
+
+A delta file is a stream of Msgpack encoded items:
+
+* A header, containing the generations before and after the changes.
+
+* A ``(keyspace, key, value)`` tuple for each changed key, where the
+  value is `None` for deleted keys. Keyspaces are identified by name
+  (see KEYSPACES). For keyspaces that exist in both slots, the active
+  slot is meant.
+
+* A trailer containing the number of changes, which marks the end of
+  a complete file.
+"""
+
+import msgpack
+
+DELTA_FORMAT = 'whip-delta'
+DELTA_VERSION = 1
+KEYSPACES = (
+    'records', 'history', 'index', 'views', 'changelog', 'meta')
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Values can be large (e.g. coverage information), but older Msgpack
+# versions limit the size of binary values to 1 MB by default.
+MAX_BUFFER_SIZE = 256 * 1024 * 1024
+
+
+def iter_diff(old, new):
+    """
+    Compare two sorted iterables of ``(key, value)`` pairs.
+
+    This generator yields ``(key, value)`` pairs for keys that are new
+    or have a different value, and ``(key, None)`` for deleted keys.
+    """
+    old = iter(old)
+    new = iter(new)
+    old_item = next(old, None)
+    new_item = next(new, None)
+    while old_item is not None or new_item is not None:
+        if new_item is None or (
+                old_item is not None and old_item[0] < new_item[0]):
+            yield old_item[0], None
+            old_item = next(old, None)
+        elif old_item is None or new_item[0] < old_item[0]:
+            yield new_item
+            new_item = next(new, None)
+        else:
+            if old_item[1] != new_item[1]:
+                yield new_item
+            old_item = next(old, None)
+            new_item = next(new, None)
+
+
+class DeltaWriter(object):
+    """Writer for delta files (to a binary file like object)."""
+
+    def __init__(self, fp, base_generation, generation):
+        self.fp = fp
+        self.pack = msgpack.Packer(use_bin_type=True).pack
+        self.n_changes = 0
+        fp.write(self.pack({
+            'format': DELTA_FORMAT,
+            'version': DELTA_VERSION,
+            'base': base_generation,
+            'generation': generation,
+        }))
+
+    def write(self, keyspace, changes):
+        """Write ``(key, value)`` changes (e.g. from iter_diff())."""
+        assert keyspace in KEYSPACES
+        write = self.fp.write
+        pack = self.pack
+        for key, value in changes:
+            write(pack((keyspace, key, value)))
+            self.n_changes += 1
+
+    def close(self):
+        """Finish the delta file."""
+        self.fp.write(self.pack({'changes': self.n_changes}))
+
+
+def read_delta(fp):
+    """
+    Read a delta file (from a binary file like object).
+
+    This returns a ``(header, changes)`` tuple, where `changes` is an
+    iterable of ``(keyspace, key, value)`` tuples. A ValueError is
+    raised for invalid files, and while iterating over the changes for
+    incomplete files.
+    """
+    unpacker = msgpack.Unpacker(
+        fp, raw=False, read_size=READ_BUFFER_SIZE,
+        max_buffer_size=MAX_BUFFER_SIZE)
+    header = next(unpacker, None)
+    if not isinstance(header, dict) or header.get('format') != DELTA_FORMAT:
+        raise ValueError("Not a delta file")
+    if header.get('version') != DELTA_VERSION:
+        raise ValueError(
+            "Unsupported delta file version: {!r}".format(
+                header.get('version')))
+
+    def iter_changes():
+        n_changes = 0
+        for item in unpacker:
+            if isinstance(item, dict):
+                if item.get('changes') != n_changes:
+                    raise ValueError("Delta file is corrupt")
+                return
+            keyspace, key, value = item
+            if keyspace not in KEYSPACES:
+                raise ValueError(
+                    "Invalid keyspace in delta file: {!r}".format(keyspace))
+            n_changes += 1
+            yield keyspace, key, value
+        raise ValueError("Delta file is incomplete")
+
+    return header, iter_changes()
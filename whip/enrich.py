@@ -0,0 +1,199 @@
+"""
+Whip enrichment module.
+
+This module enriches (large amounts of) records containing an IP address
+field with information from the database, without the overhead of
+individual lookups.
+
+Two modes are supported:
+
+* Streaming: records are processed one at a time. The range that matched
+  the previous lookup is cached, so that consecutive records for
+  addresses in the same range (or gap) do not touch the database.
+
+* Sort-merge: records are read in chunks, which are sorted by IP
+  address. The sorted addresses are then joined against the database by
+  walking a single iterator forward, which is much cheaper than random
+  seeks. The output order is the same as the input order.
+
+Memory usage is bounded in both modes.
+
+Both newline delimited JSON and CSV formats are supported. For JSON
+records, the information is added as an extra field, and for CSV, as an
+extra column (containing JSON).
+"""
+
+import csv
+import io
+import itertools
+import logging
+
+from .json import dumps as json_dumps, loads as json_loads
+from .util import ip_packed_to_int, ip_str_to_packed, PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 100 * 1000
+FORMATS = ('ndjson', 'csv')
+
+
+class RangeLookup(object):
+    """
+    Lookup helper that caches the range (or gap) of the previous lookup.
+
+    Lookups only return the latest version of the data. See
+    Database.lookup_range().
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.begin = self.end = -1
+        self.value = None
+
+    def lookup(self, ip):
+        """Lookup an IP address string (returns JSON bytes or `None`)"""
+        ip_packed = pack_ip(ip)
+        if ip_packed is None:
+            return None
+        return self.lookup_packed(ip_packed)
+
+    def lookup_packed(self, ip_packed):
+        """Lookup a packed IP address (returns JSON bytes or `None`)"""
+        ip_int = ip_packed_to_int(ip_packed)
+        if not self.begin <= ip_int <= self.end:
+            self.begin, self.end, self.value = \
+                self.db.lookup_range(ip_packed)
+        return self.value
+
+
+def pack_ip(ip):
+    """Pack an IP address string, returning `None` if it is invalid"""
+    try:
+        return ip_str_to_packed(ip)
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def enrich(db, items, chunk_size=None):
+    """
+    Enrich an iterable of ``(ip, record)`` tuples.
+
+    This generator yields ``(record, value)`` tuples in the input order,
+    where `value` is the JSON encoded data (as bytes) for the IP address,
+    or `None` if there is no information.
+
+    If `chunk_size` is specified, sort-merge mode is used: chunks of this
+    size are sorted by IP address before being joined against the
+    database. Otherwise, records are processed one at a time.
+    """
+    range_lookup = RangeLookup(db)
+    n_processed = n_hits = 0
+    reporter = PeriodicCallback(lambda: logger.info(
+        "%d records processed (%d hits)", n_processed, n_hits))
+
+    if not chunk_size:
+        lookup = range_lookup.lookup
+        for ip, record in items:
+            value = lookup(ip)
+            yield record, value
+
+            n_processed += 1
+            if value is not None:
+                n_hits += 1
+            if n_processed % 10000 == 0:
+                reporter.tick()
+    else:
+        lookup_packed = range_lookup.lookup_packed
+        it = iter(items)
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+
+            # Lookup in sorted order, but yield in input order. Invalid
+            # addresses are skipped.
+            ips_packed = [pack_ip(ip) for ip, _ in chunk]
+            order = sorted(
+                (n for n, ip_packed in enumerate(ips_packed)
+                 if ip_packed is not None),
+                key=ips_packed.__getitem__)
+            values = [None] * len(chunk)
+            for n in order:
+                values[n] = lookup_packed(ips_packed[n])
+            for (_, record), value in zip(chunk, values):
+                yield record, value
+
+            n_processed += len(chunk)
+            n_hits += len(values) - values.count(None)
+            reporter.tick()
+
+    reporter.tick(True)
+
+
+def enrich_ndjson(db, fp, out, ip_field='ip', output_field='whip',
+                  chunk_size=None):
+    """Enrich a newline delimited JSON stream (both in binary mode)
+
+    The JSON data is added to each document without decoding and
+    re-encoding it, by splicing it into the input line. Lines that do
+    not contain a single JSON object are passed through unchanged.
+    """
+    field_prefix = json_dumps(output_field).encode('UTF-8') + b':'
+    n_malformed = 0
+
+    def iter_items():
+        nonlocal n_malformed
+        for line_number, line in enumerate(fp, 1):
+            line = line.rstrip()
+            if not line:
+                continue
+            try:
+                doc = json_loads(line)
+            except ValueError:
+                doc = None
+            if not isinstance(doc, dict):
+                if not n_malformed:
+                    logger.warning(
+                        "Line %d is not a JSON object; passing it through",
+                        line_number)
+                n_malformed += 1
+                yield None, (line, None)
+                continue
+            yield doc.get(ip_field), (line, bool(doc))
+
+    write = out.write
+    for (line, non_empty), value in enrich(db, iter_items(), chunk_size):
+        if non_empty is None:
+            write(line)
+            write(b'\n')
+            continue
+        write(line[:-1])
+        if non_empty:
+            write(b',')
+        write(field_prefix)
+        write(b'null' if value is None else value)
+        write(b'}\n')
+
+    if n_malformed:
+        logger.warning(
+            "Passed through %d lines that are not JSON objects", n_malformed)
+
+
+def enrich_csv(db, fp, out, ip_field='ip', output_field='whip',
+               chunk_size=None):
+    """Enrich a CSV stream with a header row (both in binary mode)"""
+    fp = io.TextIOWrapper(fp, encoding='UTF-8', newline='')
+    out = io.TextIOWrapper(out, encoding='UTF-8', newline='')
+    reader = csv.DictReader(fp)
+    if reader.fieldnames is None:
+        return
+    writer = csv.DictWriter(out, reader.fieldnames + [output_field])
+    writer.writeheader()
+
+    items = ((row.get(ip_field), row) for row in reader)
+    for row, value in enrich(db, items, chunk_size):
+        row[output_field] = '' if value is None else value.decode('UTF-8')
+        writer.writerow(row)
+
+    out.flush()
+    out.detach()
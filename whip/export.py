@@ -0,0 +1,116 @@
+"""
+Whip export module.
+
+Exports contain a document for each range in the database, in key
+order, as newline delimited JSON in the format read by iter_json(). The
+output can be loaded into another database, or used as a snapshot of
+the data set as of a specific datetime.
+
+Reconstructing and encoding documents is pure Python and relatively
+costly, while LevelDB only allows a single process to open a database.
+The calling process therefore only reads raw chunks of consecutive
+records from the database, and hands these out to worker processes. The
+output of the workers is written in the original order.
+"""
+
+import collections
+import concurrent.futures
+import os
+
+from .db import ExistingRecord
+from .json import dumps as json_dumps, loads as json_loads
+from .util import ip_packed_to_str
+
+DEFAULT_CHUNK_SIZE = 10 * 1000
+
+# Enough pending chunks to keep all workers busy, while bounding the
+# amount of memory used.
+PENDING_CHUNKS_PER_WORKER = 4
+
+
+def export_record(record, datetime=None):
+    """Format a record (see ExistingRecord) as a line of JSON.
+
+    If `datetime` is specified, the version for that datetime is used.
+    This returns a byte string, or `None` if there is no such version.
+    The range fields are set to the range in the database, since the
+    stored information contains the range from the input data.
+    """
+    if datetime is None or record.latest_datetime <= datetime:
+        doc = json_loads(record.latest_json)
+    else:
+        for doc in record.iter_versions(inplace=True):
+            if doc['datetime'] <= datetime:
+                break
+        else:
+            return None
+
+    doc['begin'] = ip_packed_to_str(record.begin_ip_packed)
+    doc['end'] = ip_packed_to_str(record.end_ip_packed)
+    return json_dumps(doc, ensure_ascii=False).encode('UTF-8') + b'\n'
+
+
+def export_chunk(chunk, datetime=None, compresslevel=None):
+    """Format a chunk of raw records. See export_record().
+
+    The `chunk` is a ``(records, history)`` tuple, as produced by
+    Database.iter_raw_chunks(). This returns a ``(n_exported, data)``
+    tuple. If `compresslevel` is specified, the data is a gzip member;
+    concatenated gzip members are a valid gzip file.
+    """
+    records, history = chunk
+    history = dict(history)
+    from_key_value = ExistingRecord.from_key_value
+    lines = []
+    for key, value in records:
+        line = export_record(
+            from_key_value(key, value, history.get(key)), datetime)
+        if line is not None:
+            lines.append(line)
+
+    data = b''.join(lines)
+    if compresslevel is not None:
+        import gzip
+        data = gzip.compress(data, compresslevel=compresslevel)
+    return len(lines), data
+
+
+def export(db, fp, datetime=None, workers=None, compresslevel=None,
+           chunk_size=DEFAULT_CHUNK_SIZE):
+    """Export a database to a binary file like object.
+
+    See the module documentation for details. The number of `workers`
+    defaults to the number of CPUs; with a single worker, no additional
+    processes are used. See export_chunk() for `compresslevel`.
+
+    Returns the number of exported ranges.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = db.iter_raw_chunks(chunk_size)
+    n_exported = 0
+
+    if workers <= 1:
+        for chunk in chunks:
+            n, data = export_chunk(chunk, datetime, compresslevel)
+            fp.write(data)
+            n_exported += n
+        return n_exported
+
+    # Results are written in submission order. Waiting for the oldest
+    # pending chunk before submitting more limits the read-ahead.
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for chunk in chunks:
+            if len(pending) >= workers * PENDING_CHUNKS_PER_WORKER:
+                n, data = pending.popleft().result()
+                fp.write(data)
+                n_exported += n
+            pending.append(executor.submit(
+                export_chunk, chunk, datetime, compresslevel))
+        while pending:
+            n, data = pending.popleft().result()
+            fp.write(data)
+            n_exported += n
+
+    return n_exported
@@ -0,0 +1,134 @@
+"""
+Whip in-memory index module.
+
+This module implements an optional, fully in-memory index for looking up
+the latest version of a record, for latency-critical use cases. It is
+built from an existing database, and keeps all ranges and the latest
+JSON data in memory:
+
+* The JSON data for all ranges is concatenated into a single byte
+  string (the 'arena'), and ranges refer to it using offsets.
+
+* IPv4 ranges are kept in sorted arrays of 32-bit integers. A jump table
+  indexed by the first 16 bits of the address points to the ranges
+  within that prefix, so that a lookup only has to search a short slice
+  of the arrays.
+
+* Everything else (IPv6) is kept in sorted lists of packed addresses,
+  which are searched using bisection.
+"""
+
+import array
+import bisect
+import logging
+
+from .util import IPV4_MAPPED_IPV6_PREFIX
+
+logger = logging.getLogger(__name__)
+
+IPV4_BEGIN_PACKED = IPV4_MAPPED_IPV6_PREFIX + b'\x00' * 4
+IPV4_END_PACKED = IPV4_MAPPED_IPV6_PREFIX + b'\xff' * 4
+JUMP_TABLE_BITS = 16
+
+
+class MemoryIndex(object):
+    """
+    In-memory index for latest version lookups.
+
+    Ranges must be added in sorted order using add(), followed by
+    a single call to finish().
+    """
+
+    def __init__(self):
+        self.arena = bytearray()
+        self.offsets = array.array('Q', [0])
+
+        self.ipv4_begins = array.array('I')
+        self.ipv4_ends = array.array('I')
+        self.ipv4_values = array.array('I')
+        self.jump_table = None
+
+        self.ipv6_begins = []
+        self.ipv6_ends = []
+        self.ipv6_values = array.array('I')
+
+    def add(self, begin_ip_packed, end_ip_packed, latest_json):
+        """Add a range."""
+        value_idx = len(self.offsets) - 1
+        self.arena += latest_json
+        self.offsets.append(len(self.arena))
+
+        # IPv4 part of the range (if any)
+        if (begin_ip_packed <= IPV4_END_PACKED
+                and end_ip_packed >= IPV4_BEGIN_PACKED):
+            begin = max(begin_ip_packed, IPV4_BEGIN_PACKED)
+            end = min(end_ip_packed, IPV4_END_PACKED)
+            self.ipv4_begins.append(int.from_bytes(begin[12:], 'big'))
+            self.ipv4_ends.append(int.from_bytes(end[12:], 'big'))
+            self.ipv4_values.append(value_idx)
+
+        # Any part outside the IPv4 space. IPv4 lookups never use this,
+        # so there is no need to clip.
+        if (begin_ip_packed < IPV4_BEGIN_PACKED
+                or end_ip_packed > IPV4_END_PACKED):
+            self.ipv6_begins.append(begin_ip_packed)
+            self.ipv6_ends.append(end_ip_packed)
+            self.ipv6_values.append(value_idx)
+
+    def finish(self):
+        """Finish building the index."""
+        self.arena = bytes(self.arena)
+
+        # For each prefix, the jump table contains the index of the
+        # first range ending at or after the start of that prefix.
+        shift = 32 - JUMP_TABLE_BITS
+        ends = self.ipv4_ends
+        self.jump_table = array.array('I', (
+            bisect.bisect_left(ends, prefix << shift)
+            for prefix in range(2 ** JUMP_TABLE_BITS)))
+        self.jump_table.append(len(ends))
+
+        logger.info(
+            "In-memory index contains %d IPv4 and %d IPv6 ranges, "
+            "using %.1f MB",
+            len(self.ipv4_ends), len(self.ipv6_ends),
+            self.memory_usage() / (1024 * 1024))
+
+    def memory_usage(self):
+        """Estimate the memory usage (in bytes) of this index."""
+        arrays = (
+            self.offsets, self.ipv4_begins, self.ipv4_ends,
+            self.ipv4_values, self.jump_table, self.ipv6_values)
+        size = len(self.arena)
+        size += sum(a.itemsize * len(a) for a in arrays)
+        size += 2 * 8 * len(self.ipv6_ends)  # list slots
+        size += sum(map(len, self.ipv6_begins))
+        size += sum(map(len, self.ipv6_ends))
+        return size
+
+    def lookup(self, ip_packed):
+        """Lookup the latest version for a packed IP address.
+
+        This returns the JSON data as a byte string, or `None` if the
+        address is not in any range.
+        """
+        if ip_packed[:12] == IPV4_MAPPED_IPV6_PREFIX:
+            n = int.from_bytes(ip_packed[12:], 'big')
+            prefix = n >> (32 - JUMP_TABLE_BITS)
+            ends = self.ipv4_ends
+            idx = bisect.bisect_left(
+                ends, n,
+                self.jump_table[prefix],
+                self.jump_table[prefix + 1])
+            if idx == len(ends) or n < self.ipv4_begins[idx]:
+                return None
+            value_idx = self.ipv4_values[idx]
+        else:
+            ends = self.ipv6_ends
+            idx = bisect.bisect_left(ends, ip_packed)
+            if idx == len(ends) or ip_packed < self.ipv6_begins[idx]:
+                return None
+            value_idx = self.ipv6_values[idx]
+
+        offsets = self.offsets
+        return self.arena[offsets[value_idx]:offsets[value_idx + 1]]
@@ -0,0 +1,147 @@
+"""
+Whip pipelining module.
+
+Loading consists of three stages: reading the existing database,
+merging and encoding records, and writing the results. This module
+provides helpers to run the first and last stage in background threads,
+connected to the merge stage using bounded queues, so that the stages
+overlap instead of running strictly in sequence. LevelDB releases the
+GIL while reading and writing, so this helps even though the merge
+stage is pure Python.
+
+Each stage keeps track of the time it is busy, which shows which stage
+is the bottleneck.
+"""
+
+import itertools
+import queue
+import threading
+import time
+
+PREFETCH_CHUNK_SIZE = 100
+PREFETCH_QUEUE_SIZE = 64
+WRITE_QUEUE_SIZE = 8
+
+
+class Prefetcher(object):
+    """
+    Iterate over an iterable in a background thread.
+
+    Items are produced in chunks, and at most a bounded number of
+    chunks is kept in memory, blocking the background thread when the
+    consumer does not keep up.
+    """
+
+    def __init__(self, iterable, chunk_size=PREFETCH_CHUNK_SIZE,
+                 queue_size=PREFETCH_QUEUE_SIZE):
+        self.iterable = iterable
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+
+        # Time spent producing items, and time spent by the consumer
+        # waiting for items.
+        self.busy_time = 0.0
+        self.consumer_wait_time = 0.0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        it = iter(self.iterable)
+        put = self.queue.put
+        try:
+            while not self.closed:
+                start_time = time.perf_counter()
+                chunk = list(itertools.islice(it, self.chunk_size))
+                self.busy_time += time.perf_counter() - start_time
+                put(chunk)
+                if not chunk:
+                    break
+        except BaseException as exc:  # pylint: disable=broad-except
+            put(exc)
+
+    def __iter__(self):
+        get = self.queue.get
+        while True:
+            start_time = time.perf_counter()
+            chunk = get()
+            self.consumer_wait_time += time.perf_counter() - start_time
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                return
+            yield from chunk
+
+    def close(self):
+        """Stop the background thread (e.g. when not consuming all items)."""
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class BackgroundWriter(object):
+    """
+    Write LevelDB write batches in a background thread.
+
+    Batches are written in order. At most a bounded number of batches is
+    queued, blocking the caller when writing does not keep up. Errors
+    are raised by the next call to write() or close().
+    """
+
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+
+        # Time spent writing, and time spent by the caller waiting for
+        # queue space.
+        self.busy_time = 0.0
+        self.caller_wait_time = 0.0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        get = self.queue.get
+        while True:
+            wb = get()
+            if wb is None:
+                break
+            if self.error is not None:
+                continue  # Skip anything after a failed write.
+            start_time = time.perf_counter()
+            try:
+                wb.write()
+            except BaseException as exc:  # pylint: disable=broad-except
+                self.error = exc
+            self.busy_time += time.perf_counter() - start_time
+
+    def write(self, wb):
+        """Queue a write batch for writing."""
+        if self.error is not None:
+            raise self.error
+        start_time = time.perf_counter()
+        self.queue.put(wb)
+        self.caller_wait_time += time.perf_counter() - start_time
+
+    def close(self):
+        """Wait until all queued batches have been written."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def format_utilisation(elapsed, reader, writer):
+    """Format stage utilisation statistics for logging."""
+    if elapsed <= 0:
+        return "n/a"
+    merge_wait_time = reader.consumer_wait_time + writer.caller_wait_time
+    return "reading {:.0%}, merging {:.0%}, writing {:.0%}".format(
+        reader.busy_time / elapsed,
+        max(0.0, 1 - merge_wait_time / elapsed),
+        writer.busy_time / elapsed)
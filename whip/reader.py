@@ -2,6 +2,8 @@
 Whip reader module.
 """
 
+import collections
+
 from .json import loads
 from .util import ip_str_to_int
 
@@ -34,3 +36,50 @@ def iter_json(fp, range_fields=DEFAULT_RANGE_FIELDS):
             _ip_str_to_int(doc[end_field]),
             doc,
         )
+
+
+class ResumableReader(object):
+    """Reader for JSON input that keeps track of file offsets.
+
+    This behaves like iter_json(), but reads from a binary file like
+    object, which may also be a gzip file. The checkpoint() method
+    returns the offset at which reading can be resumed, and `offset`
+    can be used to start reading from that position.
+    """
+
+    def __init__(self, fp, range_fields=DEFAULT_RANGE_FIELDS, offset=0):
+        self.fp = fp
+        self.range_fields = range_fields
+        if offset:
+            fp.seek(offset)
+        self.offset = offset
+
+        # The (end, offset) pairs of the documents read so far, for
+        # checkpointing. These are discarded when no longer needed.
+        self.positions = collections.deque()
+
+    def __iter__(self):
+        begin_field, end_field = self.range_fields
+        _ip_str_to_int = ip_str_to_int
+        _loads = loads
+        positions = self.positions
+
+        for line in self.fp:
+            offset = self.offset
+            self.offset += len(line)
+            doc = _loads(line)
+            begin = _ip_str_to_int(doc[begin_field])
+            end = _ip_str_to_int(doc[end_field])
+            positions.append((end, offset))
+            yield begin, end, doc
+
+    def checkpoint(self, last_end):
+        """Return the offset to resume from after `last_end` was written.
+
+        Documents for ranges ending at or before `last_end` are not
+        needed anymore after resuming.
+        """
+        positions = self.positions
+        while positions and positions[0][0] <= last_end:
+            positions.popleft()
+        return positions[0][1] if positions else self.offset
@@ -0,0 +1,229 @@
+"""
+Whip request router for sharded databases.
+
+The router serves the same REST API as a single server, by forwarding
+requests to the servers for the shards of a sharded database (see
+`whip.shard`). Only the shard manifest is needed; the ``DATABASE_DIR``
+setting points to the directory containing it, and the ``BACKENDS``
+setting lists the base URL of the server for each shard, in order.
+
+* Lookups for a single address are forwarded to the owning shard.
+  Caching headers are passed through unchanged.
+
+* Batch lookups are split per shard, forwarded concurrently, and merged
+  again in the original order.
+
+* Range, find and change log queries are forwarded to all shards
+  involved, and the results are concatenated in shard order. These are
+  not cached.
+
+Connections to the backends are kept alive and reused.
+"""
+
+# pylint: disable=missing-docstring
+
+import collections
+import concurrent.futures
+import http.client
+import urllib.parse
+
+from flask import abort, Flask, request, Response
+
+from .json import dumps as json_dumps, loads as json_loads
+from .shard import read_manifest
+from .util import ip_prefix_to_int_range, ip_str_to_int
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 16
+
+PASSTHROUGH_HEADERS = frozenset([
+    'cache-control', 'content-type', 'etag', 'last-modified'])
+
+app = Flask(__name__)
+app.config.from_envvar('WHIP_ROUTER_SETTINGS', silent=True)
+
+
+class BackendError(Exception):
+    pass
+
+
+class Backend(object):
+    """
+    HTTP client for a backend server.
+
+    Idle connections are kept in a pool (of at most `pool_size`
+    connections), and reused by subsequent requests. This class is
+    thread-safe.
+    """
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError("Unsupported backend URL: {!r}".format(url))
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle = collections.deque()
+
+    def request(self, method, path, body=None, headers=None):
+        """Perform a request, returning a (status, headers, body) tuple."""
+        while True:
+            try:
+                conn = self.idle.pop()
+                reused = True
+            except IndexError:
+                conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+                reused = False
+
+            try:
+                conn.request(
+                    method, self.base_path + path, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    # The server may have closed an idle connection.
+                    continue
+                raise
+
+            if response.will_close or len(self.idle) >= self.pool_size:
+                conn.close()
+            else:
+                self.idle.append(conn)
+            return response.status, response.getheaders(), data
+
+
+shard_map = None
+backends = None
+executor = None
+
+
+@app.before_first_request
+def _setup():
+    global shard_map, backends, executor  # pylint: disable=global-statement
+    shard_map = read_manifest(app.config['DATABASE_DIR'])
+    if shard_map is None:
+        raise RuntimeError("Database is not sharded")
+    urls = app.config['BACKENDS']
+    if len(urls) != len(shard_map):
+        raise RuntimeError(
+            "Expected {:d} backends, got {:d}".format(
+                len(shard_map), len(urls)))
+    backends = [Backend(url) for url in urls]
+    executor = concurrent.futures.ThreadPoolExecutor(len(backends))
+
+
+def _forward_path():
+    path = urllib.parse.quote(request.path)
+    if request.query_string:
+        path += '?' + request.query_string.decode('ascii')
+    return path
+
+
+def _forward(backend, method, path, body=None, headers=None):
+    try:
+        return backend.request(method, path, body, headers)
+    except (http.client.HTTPException, OSError):
+        abort(502)
+
+
+def _fan_out(shards):
+    # Results are streamed shard by shard. The status of the first
+    # shard is used for the response; it only differs from the other
+    # shards for errors that do not depend on the data.
+    path = _forward_path()
+    shards = list(shards)
+    status, _, data = _forward(backends[shards[0]], 'GET', path)
+    if status != 200:
+        return Response(data, status)
+
+    def generate():
+        yield data
+        for n in shards[1:]:
+            status, _, shard_data = backends[n].request('GET', path)
+            if status != 200:
+                raise BackendError(
+                    "Shard {:d} returned status {:d}".format(n, status))
+            yield shard_data
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/ip/<ip>')
+def lookup(ip):
+    try:
+        n = shard_map.shard_for(ip_str_to_int(ip))
+    except (OSError, ValueError):
+        abort(400)
+
+    headers = {}
+    if 'If-None-Match' in request.headers:
+        headers['If-None-Match'] = request.headers['If-None-Match']
+    status, backend_headers, data = _forward(
+        backends[n], 'GET', _forward_path(), headers=headers)
+
+    response = Response(data, status)
+    for name, value in backend_headers:
+        if name.lower() in PASSTHROUGH_HEADERS:
+            response.headers[name] = value
+    return response
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    try:
+        ips = json_loads(request.get_data())
+        if not isinstance(ips, list):
+            raise ValueError("not a list")
+        shards = [shard_map.shard_for(ip_str_to_int(ip)) for ip in ips]
+    except (OSError, TypeError, ValueError):
+        abort(400)
+
+    # Split the batch per shard, and remember the positions.
+    positions = collections.defaultdict(list)
+    for idx, n in enumerate(shards):
+        positions[n].append(idx)
+
+    path = _forward_path()
+    futures = {
+        n: executor.submit(
+            _forward, backends[n], 'POST', path,
+            body=json_dumps([ips[idx] for idx in idxs]).encode('UTF-8'),
+            headers={'Content-Type': 'application/json'})
+        for n, idxs in positions.items()}
+
+    lines = [None] * len(ips)
+    for n, future in futures.items():
+        status, _, data = future.result()
+        if status != 200:
+            return Response(data, status)
+        for idx, line in zip(positions[n], data.splitlines()):
+            lines[idx] = line
+    lines.append(b'')
+
+    return Response(b'\n'.join(lines), mimetype='application/x-ndjson')
+
+
+@app.route('/range/<path:prefix>')
+def scan(prefix):
+    try:
+        begin, end = ip_prefix_to_int_range(prefix)
+    except (OSError, ValueError):
+        abort(400)
+    return _fan_out(shard_map.shards_for_range(begin, end))
+
+
+@app.route('/find/<field>/<value>')
+def find(field, value):  # pylint: disable=unused-argument
+    return _fan_out(range(len(backends)))
+
+
+@app.route('/changes')
+def changes():
+    return _fan_out(range(len(backends)))
@@ -0,0 +1,192 @@
+"""
+Whip sharding module.
+
+A database can be partitioned into shards, each covering a contiguous
+part of the IP address space, so that it can be spread over multiple
+machines. Each shard is a normal database, stored in a subdirectory of
+the sharded database directory, and is served separately. A router
+(see `whip.router`) forwards requests to the right shard.
+
+The shard boundaries are kept in a manifest file. They are chosen when
+the sharded database is created, such that all shards contain roughly
+the same number of ranges, and never change afterwards. Input ranges
+crossing a shard boundary are split.
+"""
+
+import bisect
+import logging
+import os
+import random
+
+from .db import Database
+from .json import dumps as json_dumps, loads as json_loads
+from .util import ip_int_to_str, ip_str_to_int
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'shards.json'
+DEFAULT_SAMPLE_SIZE = 100 * 1000
+
+MAX_IP_INT = 2 ** 128 - 1
+
+
+class ShardMap(object):
+    """
+    Map of the shards of a sharded database.
+
+    Shard `n` covers the addresses from ``begins[n]`` up to (but not
+    including) ``begins[n + 1]``. The first shard starts at address 0,
+    and the last shard covers the remainder of the address space.
+    """
+
+    def __init__(self, begins):
+        if not begins or begins[0] != 0 or list(begins) != sorted(begins):
+            raise ValueError("Invalid shard boundaries")
+        self.begins = list(begins)
+
+    def __len__(self):
+        return len(self.begins)
+
+    def shard_for(self, ip_int):
+        """Return the shard number for an IP address (as an integer)."""
+        return bisect.bisect_right(self.begins, ip_int) - 1
+
+    def shards_for_range(self, begin, end):
+        """Return the shard numbers overlapping a range of IP addresses."""
+        return range(self.shard_for(begin), self.shard_for(end) + 1)
+
+    def shard_range(self, n):
+        """Return the ``(begin, end)`` range covered by a shard."""
+        begins = self.begins
+        end = begins[n + 1] - 1 if n + 1 < len(begins) else MAX_IP_INT
+        return begins[n], end
+
+    def to_json(self):
+        return json_dumps({'begins': list(map(ip_int_to_str, self.begins))})
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(list(map(ip_str_to_int, json_loads(value)['begins'])))
+
+
+def shard_dir(database_dir, n):
+    """Return the directory of a shard of a sharded database."""
+    return os.path.join(database_dir, 'shard-{:d}'.format(n))
+
+
+def read_manifest(database_dir):
+    """Read the shard map of a sharded database (or `None`)."""
+    try:
+        with open(os.path.join(database_dir, MANIFEST_FILENAME)) as fp:
+            return ShardMap.from_json(fp.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(database_dir, shard_map):
+    """Write the shard map of a sharded database."""
+    os.makedirs(database_dir, exist_ok=True)
+    filename = os.path.join(database_dir, MANIFEST_FILENAME)
+    with open(filename + '.tmp', 'w') as fp:
+        fp.write(shard_map.to_json())
+    os.replace(filename + '.tmp', filename)
+
+
+def choose_shard_map(iterables, n_shards, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Choose shard boundaries for the data from the specified iterables.
+
+    The boundaries are chosen such that the shards contain roughly the
+    same number of ranges, based on a random sample of (at most
+    `sample_size`) range beginnings. If there are few distinct ranges,
+    fewer shards may be used.
+    """
+    if n_shards < 1:
+        raise ValueError("Invalid number of shards: {!r}".format(n_shards))
+
+    # Reservoir sampling keeps a uniform sample using bounded memory.
+    rng = random.Random(0)
+    sample = []
+    n = 0
+    for iterable in iterables:
+        for begin, _, _ in iterable:
+            n += 1
+            if len(sample) < sample_size:
+                sample.append(begin)
+            else:
+                idx = rng.randrange(n)
+                if idx < sample_size:
+                    sample[idx] = begin
+
+    sample.sort()
+    begins = [0]
+    for i in range(1, n_shards):
+        if not sample:
+            break
+        begin = sample[len(sample) * i // n_shards]
+        if begin > begins[-1]:
+            begins.append(begin)
+
+    if len(begins) < n_shards:
+        logger.warning(
+            "Using %d shards instead of %d (not enough distinct ranges)",
+            len(begins), n_shards)
+    return ShardMap(begins)
+
+
+class ShardSplitter(object):
+    """
+    Splitter for a sorted iterable of ``(begin, end, doc)`` tuples.
+
+    The shard() method returns an iterable for the part of the data
+    belonging to a shard. Since the input is only read once, these must
+    be consumed completely, in shard order.
+    """
+
+    def __init__(self, iterable, shard_map):
+        self.it = iter(iterable)
+        self.shard_map = shard_map
+        self.pending = None
+
+    def shard(self, n):
+        """Iterate over the part of the data belonging to a shard."""
+        shard_begin, shard_end = self.shard_map.shard_range(n)
+        while True:
+            item, self.pending = self.pending, None
+            if item is None:
+                item = next(self.it, None)
+                if item is None:
+                    return
+
+            begin, end, doc = item
+            if end < shard_begin:
+                continue  # Belongs to a preceding shard.
+            if begin > shard_end:
+                self.pending = item
+                return
+            if end > shard_end:
+                # The remainder belongs to the next shard.
+                self.pending = (shard_end + 1, end, doc)
+                end = shard_end
+            yield max(begin, shard_begin), end, doc
+
+
+def load_shards(database_dir, shard_map, iterables, retention=None,
+                **options):
+    """
+    Load data into all shards of a sharded database.
+
+    The shards are loaded one after another, while reading the input
+    only once. Any other options are passed to the Database constructor.
+    """
+    splitters = [ShardSplitter(it, shard_map) for it in iterables]
+    for n in range(len(shard_map)):
+        logger.info("Loading shard %d of %d", n + 1, len(shard_map))
+        db = Database(
+            shard_dir(database_dir, n), create_if_missing=True, **options)
+        try:
+            db.load(
+                *[splitter.shard(n) for splitter in splitters],
+                retention=retention)
+        finally:
+            db.close()
@@ -0,0 +1,118 @@
+"""
+Whip input sorting module.
+
+Loading requires sorted, non-overlapping input. This module provides an
+external merge sort that can sort input files of arbitrary size using
+bounded memory, and a way to resolve overlapping ranges.
+
+The external sort reads the input in chunks, sorts each chunk in memory,
+and writes it as a sorted 'run' to a temporary file. Finally, all runs
+are combined using a k-way merge. Runs are stored as a stream of Msgpack
+encoded ``(begin, end, doc)`` tuples, with the IP addresses packed.
+"""
+
+import heapq
+import itertools
+import logging
+import operator
+import tempfile
+
+import msgpack
+
+from .util import ip_int_to_packed, ip_int_to_str, ip_packed_to_int
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1000 * 1000
+READ_BUFFER_SIZE = 1024 * 1024
+
+OVERLAP_POLICIES = ('error', 'skip', 'clip')
+
+RANGE_GETTER = operator.itemgetter(0, 1)
+
+
+def _write_run(items, tmp_dir):
+    """Write a sorted run to a temporary file"""
+    fp = tempfile.TemporaryFile(dir=tmp_dir)
+    pack = msgpack.Packer(use_bin_type=True).pack
+    for begin, end, doc in items:
+        fp.write(pack((ip_int_to_packed(begin), ip_int_to_packed(end), doc)))
+    fp.seek(0)
+    return fp
+
+
+def _read_run(fp):
+    """Read a sorted run from a temporary file"""
+    unpacker = msgpack.Unpacker(
+        fp, raw=False, read_size=READ_BUFFER_SIZE)
+    with fp:
+        for begin, end, doc in unpacker:
+            yield ip_packed_to_int(begin), ip_packed_to_int(end), doc
+
+
+def external_sort(iterable, buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None):
+    """
+    Sort ``(begin, end, doc)`` tuples using bounded memory.
+
+    At most `buffer_size` items are kept in memory; the rest is spilled
+    to temporary files in `tmp_dir`. Items are sorted by begin and end
+    of the range.
+    """
+    it = iter(iterable)
+    runs = []
+    while True:
+        chunk = list(itertools.islice(it, buffer_size))
+        chunk.sort(key=RANGE_GETTER)
+        if not runs and len(chunk) < buffer_size:
+            # Everything fits in memory; no need for temporary files.
+            yield from chunk
+            return
+
+        if chunk:
+            runs.append(_write_run(chunk, tmp_dir))
+            logger.info(
+                "Wrote sorted run %d (%d items)", len(runs), len(chunk))
+        if len(chunk) < buffer_size:
+            break
+
+    logger.info("Merging %d sorted runs", len(runs))
+    yield from heapq.merge(*map(_read_run, runs), key=RANGE_GETTER)
+
+
+def resolve_overlaps(iterable, policy='error'):
+    """
+    Resolve overlapping ranges in a sorted iterable.
+
+    The `policy` determines how overlapping ranges are handled:
+
+    * 'error': raise a ValueError
+    * 'skip': drop ranges that overlap a preceding range
+    * 'clip': remove the overlapping part from ranges that overlap
+      a preceding range; ranges that are completely covered by
+      a preceding range are dropped
+
+    In all cases, the range starting first wins.
+    """
+    if policy not in OVERLAP_POLICIES:
+        raise ValueError("Invalid overlap policy: {!r}".format(policy))
+
+    previous_end = -1
+    n_overlaps = 0
+    for begin, end, doc in iterable:
+        if begin <= previous_end:
+            n_overlaps += 1
+            if policy == 'error':
+                raise ValueError(
+                    "Range {}-{} overlaps a preceding range".format(
+                        ip_int_to_str(begin), ip_int_to_str(end)))
+            if policy == 'skip' or end <= previous_end:
+                continue
+            begin = previous_end + 1
+
+        yield begin, end, doc
+        previous_end = end
+
+    if n_overlaps:
+        logger.warning(
+            "Resolved %d overlapping ranges (policy: %s)",
+            n_overlaps, policy)
@@ -75,6 +75,32 @@ def ip_str_to_packed(s):
         return inet_pton(AF_INET6, s)
 
 
+def ip_prefix_to_int_range(s):
+    """Convert a CIDR prefix string to a (begin, end) range of integers.
+
+    Host bits are ignored, e.g. '10.1.2.3/8' means '10.0.0.0/8'.
+    A single address is accepted as well.
+    """
+    address, _, length = s.partition('/')
+    try:
+        # IPv4
+        n = int.from_bytes(inet_pton(AF_INET, address), 'big')
+        n |= 0xffff00000000
+        max_length = 32
+    except OSError:
+        # IPv6
+        n = int.from_bytes(inet_pton(AF_INET6, address), 'big')
+        max_length = 128
+
+    length = int(length) if length else max_length
+    if not 0 <= length <= max_length:
+        raise ValueError("Invalid prefix length: {}".format(length))
+
+    host_bits = max_length - length
+    begin = n >> host_bits << host_bits
+    return begin, begin | ((1 << host_bits) - 1)
+
+
 #
 # Range merging
 #
@@ -1,12 +1,28 @@
 """
 Whip's REST API
+
+Responses only change when the database is rewritten, so each response
+carries an ETag derived from the database generation (see Database),
+and conditional requests are answered without performing a lookup. The
+``Cache-Control`` max-age (in seconds) can be configured using the
+``CACHE_MAX_AGE`` setting.
+
+Batch lookups are not cached. The maximum number of addresses per batch
+can be configured using the ``MAX_BATCH_SIZE`` setting.
 """
 
 # pylint: disable=missing-docstring
 
-from flask import Flask, make_response, request
+import datetime as dt
+
+from flask import abort, Flask, make_response, request, Response
 
-from .db import Database
+from .db import Database, format_range_json
+from .json import loads as json_loads
+from .util import ip_int_to_str, ip_prefix_to_int_range
+
+DEFAULT_CACHE_MAX_AGE = 3600
+DEFAULT_MAX_BATCH_SIZE = 10000
 
 app = Flask(__name__)
 app.config.from_envvar('WHIP_SETTINGS', silent=True)
@@ -18,11 +34,54 @@ db = None
 @app.before_first_request
 def _open_db():
     global db  # pylint: disable=global-statement
-    db = Database(app.config['DATABASE_DIR'])
+    db = Database(
+        app.config['DATABASE_DIR'],
+        **app.config.get('DATABASE_OPTIONS', {}))
+
+
+def _set_cache_headers(response):
+    if db.generation is None:
+        # Database written by an older version; nothing to go by.
+        return
+
+    # The URL (including the query string) identifies the resource, so
+    # the generation suffices as a strong entity tag.
+    response.set_etag(db.generation)
+    response.last_modified = dt.datetime.fromtimestamp(
+        db.generation_time, dt.timezone.utc)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get(
+        'CACHE_MAX_AGE', DEFAULT_CACHE_MAX_AGE)
+
+
+def _not_modified():
+    if db.generation is None:
+        return None
+    if not request.if_none_match.contains_weak(db.generation):
+        return None
+    response = make_response(b'', 304)
+    _set_cache_headers(response)
+    return response
+
+
+def _ranges_response(results):
+    # Stream the results as newline delimited JSON, since the number of
+    # ranges can be very large.
+    def generate():
+        for result in results:
+            yield format_range_json(*result) + b'\n'
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    _set_cache_headers(response)
+    return response
 
 
 @app.route('/ip/<ip>')
 def lookup(ip):
+    response = _not_modified()
+    if response is not None:
+        return response
+
     datetime = request.args.get('datetime')
     info_as_json = db.lookup(ip, datetime)
 
@@ -31,4 +90,73 @@ def lookup(ip):
 
     response = make_response(info_as_json)
     response.headers['Content-type'] = 'application/json'
+    _set_cache_headers(response)
     return response
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    # The request contains a JSON list of IP addresses. The response
+    # contains one line for each address, in the same order.
+    try:
+        ips = json_loads(request.get_data())
+    except ValueError:
+        abort(400)
+    max_batch_size = app.config.get('MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+    if not isinstance(ips, list) or len(ips) > max_batch_size:
+        abort(400)
+
+    datetime = request.args.get('datetime')
+    lookup = db.lookup
+    lines = []
+    for ip in ips:
+        try:
+            info_as_json = lookup(ip, datetime)
+        except (OSError, TypeError, ValueError):
+            abort(400)
+        lines.append(b'{}' if info_as_json is None else info_as_json)
+        lines.append(b'\n')
+
+    return Response(b''.join(lines), mimetype='application/x-ndjson')
+
+
+@app.route('/range/<path:prefix>')
+def scan(prefix):
+    response = _not_modified()
+    if response is not None:
+        return response
+
+    try:
+        begin, end = ip_prefix_to_int_range(prefix)
+    except (OSError, ValueError):
+        abort(400)
+
+    datetime = request.args.get('datetime')
+    return _ranges_response(
+        db.scan(ip_int_to_str(begin), ip_int_to_str(end), datetime))
+
+
+@app.route('/find/<field>/<value>')
+def find(field, value):
+    response = _not_modified()
+    if response is not None:
+        return response
+
+    if field not in db.index_fields:
+        abort(404)
+
+    return _ranges_response(db.find(field, value))
+
+
+@app.route('/changes')
+def changes():
+    response = _not_modified()
+    if response is not None:
+        return response
+
+    since = request.args.get('since')
+    if since is None:
+        abort(400)
+
+    return _ranges_response(
+        db.changes_since(since, request.args.get('until')))